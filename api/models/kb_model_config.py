@@ -1,8 +1,10 @@
 from typing import Dict, Optional, Any, Tuple, List
 from dataclasses import dataclass
+from functools import lru_cache
+import copy
 import re
 import logging
-from enum import Enum
+from enum import Enum, IntEnum
 from pydantic import BaseModel, Field
 from config.logging_config import logger
 
@@ -28,6 +30,11 @@ class ModelProvider(Enum):
     AI21 = "ai21"
     UNKNOWN = "unknown"
 
+class AmazonFamily(IntEnum):
+    """Amazon model families that take different request and response formats."""
+    NOVA = 0
+    TITAN = 1
+
 @dataclass
 class KBModelPricing:
     """Represents the pricing for an LLM model."""
@@ -88,6 +95,7 @@ class KBModelConfig:
         top_k: int = 250,
         stop_sequences: Optional[List[str]] = None,
         supports_query_decomposition: bool = False,
+        supports_prompt_caching: bool = False,
         pricing: Optional[KBModelPricing] = None,
         guardrails: Optional[GuardrailSettings] = None
     ):
@@ -97,10 +105,18 @@ class KBModelConfig:
         self.temperature = temperature
         self.top_p = top_p
         self.top_k = top_k
-        self.stop_sequences = stop_sequences or []
+        # Immutable so cached configurations and request bodies can share it safely
+        self.stop_sequences = tuple(stop_sequences or ())
         self.supports_query_decomposition = supports_query_decomposition
+        self.supports_prompt_caching = supports_prompt_caching
         self.pricing = pricing or KBModelPricing(0.0001, 0.0003)
         self.guardrails = guardrails or GuardrailSettings()
+        # Resolved once per configuration so request building, response parsing and
+        # usage extraction only compare the family tag
+        if provider == ModelProvider.AMAZON:
+            self.amazon_family = AmazonFamily.NOVA if "nova" in model_id.lower() else AmazonFamily.TITAN
+        else:
+            self.amazon_family = None
 
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -112,6 +128,7 @@ class KBModelConfig:
             "top_k": self.top_k,
             "stop_sequences": self.stop_sequences,
             "supports_query_decomposition": self.supports_query_decomposition,
+            "supports_prompt_caching": self.supports_prompt_caching,
             "pricing": self.pricing.to_dict(),
             "guardrails": {
                 "guardrailIdentifier": self.guardrails.guardrailIdentifier,
@@ -130,14 +147,16 @@ class KBModelConfig:
             guardrails=self.guardrails
         )
 
-    def update_from_settings(self, settings: GenerationSettings) -> None:
-        """Update configuration from GenerationSettings."""
-        self.temperature = settings.temperature
-        self.top_p = settings.top_p
-        self.top_k = settings.top_k
-        self.max_tokens = settings.max_tokens
-        self.stop_sequences = settings.stop_sequences
-        self.guardrails = settings.guardrails or self.guardrails
+    def update_from_settings(self, settings: GenerationSettings) -> 'KBModelConfig':
+        """Return a copy of this configuration updated from GenerationSettings."""
+        config = copy.copy(self)
+        config.temperature = settings.temperature
+        config.top_p = settings.top_p
+        config.top_k = settings.top_k
+        config.max_tokens = settings.max_tokens
+        config.stop_sequences = tuple(settings.stop_sequences or ())
+        config.guardrails = settings.guardrails or self.guardrails
+        return config
 
 class ModelFamilyMapper:
     """Handles mapping of model names to families."""
@@ -159,6 +178,8 @@ class ModelFamilyMapper:
         r'claude-3-haiku-\d{8}': 'claude-3-haiku',
         r'claude-3\.5-sonnet-\d{8}': 'claude-3.5-sonnet',
         r'claude-3-5-sonnet-\d{8}': 'claude-3.5-sonnet',
+        r'claude-3-5-haiku-\d{8}': 'claude-3.5-haiku',
+        r'claude-3-7-sonnet-\d{8}': 'claude-3.7-sonnet',
         
         # Cohere models
         r'command-r-plus': 'command-r-plus',
@@ -190,6 +211,10 @@ class ModelFamilyMapper:
 class KBModelConfigs:
     """Manages configurations for different LLM models."""
     
+    # Mark stable prompt sections (e.g. the system prompt) as cacheable for models
+    # that support Bedrock prompt caching
+    PROMPT_CACHING = True
+
     # Default configuration
     DEFAULT_CONFIG = KBModelConfig(
         model_id="unknown",
@@ -222,8 +247,13 @@ class KBModelConfigs:
     }
 
     @classmethod
+    @lru_cache(maxsize=128)
     def get_config(cls, model_arn: str) -> KBModelConfig:
-        """Get configuration for a model based on its ARN."""
+        """Get configuration for a model based on its ARN.
+
+        Configurations are cached and shared per ARN, so they must not be modified;
+        use update_from_settings to get an adjusted copy.
+        """
         try:
             identifier = ModelIdentifier(model_arn)
             model_family = ModelFamilyMapper.get_family(identifier.model_name)
@@ -239,6 +269,7 @@ class KBModelConfigs:
                 temperature=cls.DEFAULT_CONFIG.temperature,
                 top_p=cls.DEFAULT_CONFIG.top_p,
                 supports_query_decomposition=cls._supports_decomposition(identifier),
+                supports_prompt_caching=cls._supports_prompt_caching(identifier),
                 pricing=pricing
             )
         except Exception as e:
@@ -271,6 +302,19 @@ class KBModelConfigs:
         model_family = ModelFamilyMapper.get_family(identifier.model_name)
         return model_family in decomposition_supported
 
+    @classmethod
+    def _supports_prompt_caching(cls, identifier: ModelIdentifier) -> bool:
+        """Determine if model supports Bedrock prompt caching."""
+        prompt_caching_supported = [
+            'claude-3.5-haiku',
+            'claude-3.7-sonnet',
+            'nova-pro',
+            'nova-lite',
+            'nova-micro'
+        ]
+        model_family = ModelFamilyMapper.get_family(identifier.model_name)
+        return model_family in prompt_caching_supported
+
     @classmethod
     def enrich_model_info(cls, model_info: Dict[str, Any]) -> Dict[str, Any]:
         """Enrich model information with configuration and pricing."""
@@ -285,6 +329,7 @@ class KBModelConfigs:
                     "top_k": config.top_k,
                     "stop_sequences": config.stop_sequences,
                     "supports_query_decomposition": config.supports_query_decomposition,
+                    "supports_prompt_caching": config.supports_prompt_caching,
                     "guardrails": config.guardrails.dict() if config.guardrails else None
                 },
                 "pricing": config.pricing.to_dict()
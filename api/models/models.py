@@ -27,6 +27,11 @@ class QueryRequest(BaseModel):
     system_prompt: Optional[str] = None
     knowledge_base_id: Optional[str] = None
     model_arn: Optional[str] = None
+    stream: bool = True
+    # Reference text reused across questions, sent ahead of the prompt on direct model
+    # queries so it can be served from Bedrock's prompt cache (knowledge base queries
+    # only use it with KB_PROMPT_OVERRIDES enabled)
+    context: Optional[str] = None
 
 class ModelInfo(BaseModel):
     model_arn: str
@@ -63,7 +63,9 @@ async def query(request: QueryRequest):
             request.settings,
             request.system_prompt,
             request.knowledge_base_id,
-            request.model_arn
+            request.model_arn,
+            request.stream,
+            request.context
         ),
         #media_type="application/json"
         media_type="text/event-stream"
@@ -1,4 +1,7 @@
+import asyncio
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from botocore.config import Config
 from dotenv import load_dotenv
 import os
@@ -12,23 +15,55 @@ bucket = os.getenv('S3_BUCKET')
 model_id = os.getenv('MODEL_ID')
 KNOWLEDGE_BASE_ID = os.getenv('KNOWLEDGE_BASE_ID')
 DATA_SOURCE_ID = os.getenv('DATA_SOURCE_ID')
+# Bedrock inference latency mode: 'optimized' opts supported models into latency-optimized
+# inference, 'standard' (the default) is available for every model
+PERFORMANCE_LATENCY = os.getenv('BEDROCK_PERFORMANCE_LATENCY', 'standard')
+# Completed answers to identical queries are reused for this many seconds (0, the
+# default, disables it); only enable it where replaying an earlier answer is acceptable.
+# The cache is cleared when this API starts a sync and when the sync status endpoint sees
+# a newly completed ingestion job; syncs started and finished elsewhere go unnoticed until
+# then, so keep the TTL within the staleness that is acceptable after a sync
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '0'))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '4096'))
+# Knowledge base queries use Bedrock's default generation prompt; when enabled, a request's
+# system prompt and context are placed ahead of it instead of being ignored
+KB_PROMPT_OVERRIDES = os.getenv('KB_PROMPT_OVERRIDES', 'false').lower() == 'true'
 
 # Construct model ARN
 model_arn = f'arn:aws:bedrock:{region}::foundation-model/{model_id}'
 
+# Clients are thread-safe and shared by the worker threads that run blocking
+# calls, so the connection pool is sized above botocore's default of 10
+MAX_POOL_CONNECTIONS = 64
+
 # AWS Config
 config = Config(
     region_name=region,
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
     retries=dict(
-        max_attempts=3,
-        mode='standard'
+        max_attempts=5,
+        mode='adaptive'
     )
 )
 
+# One session per process; every client below is created from it once at import
+session = boto3.session.Session(region_name=region)
+
 # Initialize AWS clients
-bedrock_agent_runtime_client = boto3.client("bedrock-agent-runtime", config=config)
-s3_client = boto3.client("s3")
-bedrock_agent = boto3.client('bedrock-agent', config=config)
-bedrock_client = boto3.client('bedrock', config=config)
-bedrock_runtime = boto3.client('bedrock-runtime', config=config)
-cloudwatch_client = boto3.client('cloudwatch', region_name=region)
\ No newline at end of file
+bedrock_agent_runtime_client = session.client("bedrock-agent-runtime", config=config)
+s3_client = session.client("s3", config=config)
+bedrock_agent = session.client('bedrock-agent', config=config)
+bedrock_client = session.client('bedrock', config=config)
+bedrock_runtime = session.client('bedrock-runtime', config=config)
+cloudwatch_client = session.client('cloudwatch', config=config)
+ce_client = session.client('ce', config=config)
+
+# Dedicated worker threads for blocking AWS calls, sized to the connection pool so
+# AWS I/O neither competes with the default executor nor queues on the pool
+AWS_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_POOL_CONNECTIONS, thread_name_prefix='aws')
+
+async def run_aws(fn, *args, **kwargs):
+    """Run a blocking AWS call on the shared AWS executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(AWS_EXECUTOR, partial(fn, *args, **kwargs))
\ No newline at end of file
@@ -1,9 +1,8 @@
 from fastapi import HTTPException, UploadFile, Response
 from typing import Optional, Dict, Any
-from config.aws_config import s3_client, bucket
+from config.aws_config import s3_client, bucket, run_aws
 from botocore.exceptions import ClientError
 from uuid import uuid4
-from io import BytesIO
 from datetime import datetime
 
 class DocumentService:
@@ -12,7 +11,7 @@ class DocumentService:
         """List all documents in S3 bucket with optional filtering"""
         try:
             # Get documents from S3
-            s3_response = s3_client.list_objects_v2(Bucket=bucket)
+            s3_response = await run_aws(s3_client.list_objects_v2, Bucket=bucket)
             
             documents = []
             if 'Contents' in s3_response:
@@ -23,7 +22,7 @@ class DocumentService:
                     # Get metadata for the file
                     original_filename = None
                     try:
-                        metadata_response = s3_client.head_object(Bucket=bucket, Key=key)
+                        metadata_response = await run_aws(s3_client.head_object, Bucket=bucket, Key=key)
                         original_filename = metadata_response.get('Metadata', {}).get('original_filename')
                     except ClientError:
                         pass
@@ -65,8 +64,8 @@ class DocumentService:
     async def get_document(document_key: str):
         """Get document from S3"""
         try:
-            response = s3_client.get_object(Bucket=bucket, Key=document_key)
-            content = response['Body'].read()
+            response = await run_aws(s3_client.get_object, Bucket=bucket, Key=document_key)
+            content = await run_aws(response['Body'].read)
             
             return {
                 'content': content,
@@ -83,7 +82,7 @@ class DocumentService:
     async def get_document_details(document_key: str) -> Dict[str, Any]:
         """Get document metadata from S3"""
         try:
-            response = s3_client.head_object(Bucket=bucket, Key=document_key)
+            response = await run_aws(s3_client.head_object, Bucket=bucket, Key=document_key)
             
             return {
                 'key': document_key,
@@ -109,12 +108,13 @@ class DocumentService:
             file_extension = file.filename.split('.')[-1].lower() if '.' in file.filename else ''
             unique_filename = f"{str(uuid4())}.{file_extension}"
             
-            # Read file content
-            content = await file.read()
+            # Stream the spooled upload straight to S3 without buffering it in memory
+            file.file.seek(0)
             
             # Upload to S3
-            s3_client.upload_fileobj(
-                BytesIO(content),
+            await run_aws(
+                s3_client.upload_fileobj,
+                file.file,
                 bucket,
                 unique_filename,
                 ExtraArgs={
@@ -138,7 +138,8 @@ class DocumentService:
     async def delete_document(document_key: str) -> Dict[str, str]:
         """Delete document from S3"""
         try:
-            s3_client.delete_object(
+            await run_aws(
+                s3_client.delete_object,
                 Bucket=bucket,
                 Key=document_key
             )
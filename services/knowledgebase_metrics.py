@@ -1,6 +1,5 @@
-from config.aws_config import cloudwatch_client
-import boto3
-from typing import Dict, List, Set
+from config.aws_config import cloudwatch_client, ce_client
+from typing import Dict, List, Set, Tuple
 from config.logging_config import logging
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
@@ -12,8 +11,6 @@ class KnowledgebaseMetricsService:
     def get_ai_usage_metrics() -> Dict:
         """Get detailed AI service usage metrics with dynamic model detection"""
         try:
-            ce_client = boto3.client('ce')
-            
             end_date = datetime.utcnow().strftime('%Y-%m-%d')
             start_date = (datetime.utcnow() - relativedelta(months=12)).replace(day=1).strftime('%Y-%m-%d')
             
@@ -124,21 +121,19 @@ class KnowledgebaseMetricsService:
     def _process_ai_costs(response: Dict) -> Dict:
         """Process AI services cost data with dynamic model detection"""
         
-        # Initialize data structures
-        model_costs = defaultdict(lambda: {
-            "total_cost": 0.0,
-            "input_tokens": 0,
-            "output_tokens": 0,
-            "total_tokens": 0,
-            "regions": defaultdict(float),
-            "usage_types": defaultdict(float)
-        })
-        
-        monthly_costs = defaultdict(lambda: {
-            "total_cost": 0.0,
-            "models": defaultdict(float),
-            "services": defaultdict(float)
-        })
+        # Per-model metrics are kept as parallel arrays indexed by model position,
+        # with the per-region and per-usage-type breakdowns keyed flat by (index, key)
+        model_index: Dict[str, int] = {}
+        model_total_cost: List[float] = []
+        model_input_tokens: List[float] = []
+        model_output_tokens: List[float] = []
+        model_regions: Dict[Tuple[int, str], float] = defaultdict(float)
+        model_usage_types: Dict[Tuple[int, str], float] = {}
+
+        # Monthly metrics keyed flat by month and (month, name)
+        month_total_cost: Dict[str, float] = defaultdict(float)
+        month_models: Dict[Tuple[str, str], float] = defaultdict(float)
+        month_services: Dict[Tuple[str, str], float] = defaultdict(float)
 
         total_metrics = {
             "total_cost": 0.0,
@@ -177,9 +172,9 @@ class KnowledgebaseMetricsService:
                     model_name = service.replace("Amazon ", "")
 
                 # Update monthly costs
-                monthly_costs[month]["total_cost"] += cost
-                monthly_costs[month]["services"][service] += cost
-                monthly_costs[month]["models"][model_name] += cost
+                month_total_cost[month] += cost
+                month_services[(month, service)] += cost
+                month_models[(month, model_name)] += cost
 
                 # Update total metrics
                 total_metrics["total_cost"] += cost
@@ -189,21 +184,50 @@ class KnowledgebaseMetricsService:
                     total_metrics["regions"][region] += cost
 
                 # Update model-specific metrics
-                model_costs[model_name]["total_cost"] += cost
+                idx = model_index.setdefault(model_name, len(model_index))
+                if idx == len(model_total_cost):
+                    model_total_cost.append(0.0)
+                    model_input_tokens.append(0)
+                    model_output_tokens.append(0)
+
+                model_total_cost[idx] += cost
                 if region:
-                    model_costs[model_name]["regions"][region] += cost
-                model_costs[model_name]["usage_types"][usage_type] = usage
+                    model_regions[(idx, region)] += cost
+                model_usage_types[(idx, usage_type)] = usage
 
                 # Track token usage if applicable
                 if token_type == 'input':
-                    model_costs[model_name]["input_tokens"] += usage
+                    model_input_tokens[idx] += usage
                 elif token_type == 'output':
-                    model_costs[model_name]["output_tokens"] += usage
-                
-                model_costs[model_name]["total_tokens"] = (
-                    model_costs[model_name]["input_tokens"] + 
-                    model_costs[model_name]["output_tokens"]
-                )
+                    model_output_tokens[idx] += usage
+
+        # Assemble the per-model view from the parallel arrays
+        model_costs = {
+            model_name: {
+                "total_cost": model_total_cost[idx],
+                "input_tokens": model_input_tokens[idx],
+                "output_tokens": model_output_tokens[idx],
+                "total_tokens": model_input_tokens[idx] + model_output_tokens[idx],
+                "regions": {},
+                "usage_types": {}
+            }
+            for model_name, idx in model_index.items()
+        }
+        model_names = list(model_index)
+        for (idx, region), region_cost in model_regions.items():
+            model_costs[model_names[idx]]["regions"][region] = region_cost
+        for (idx, usage_type), usage in model_usage_types.items():
+            model_costs[model_names[idx]]["usage_types"][usage_type] = usage
+
+        # Assemble the per-month view
+        monthly_costs = {
+            month: {"total_cost": month_cost, "models": {}, "services": {}}
+            for month, month_cost in month_total_cost.items()
+        }
+        for (month, model_name), month_cost in month_models.items():
+            monthly_costs[month]["models"][model_name] = month_cost
+        for (month, service), month_cost in month_services.items():
+            monthly_costs[month]["services"][service] = month_cost
 
         # Calculate percentages
         total_cost = total_metrics["total_cost"]
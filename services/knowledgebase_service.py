@@ -1,61 +1,99 @@
 
 import re
-from config.aws_config import bedrock_client
+import copy
+from functools import lru_cache
+from time import monotonic
+from config.aws_config import bedrock_client, run_aws
 from api.models.kb_model_config import KBModelConfigs
-from typing import Dict, List, Optional
-from datetime import datetime, timedelta
-from config.aws_config import bedrock_agent, bedrock_agent_runtime_client
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timezone
+from concurrent.futures import Future
+from config.aws_config import bedrock_agent, bedrock_agent_runtime_client, AWS_EXECUTOR
+from config.logging_config import logger
+
+# Splits a model ARN into its base ARN and context-window suffix (e.g. ":200k")
+_BASE_ARN_RE = re.compile(r'(.+?:\d+):(\d+[kKmM]?)$')
+# Extracts the model name from a foundation model ARN
+_FM_NAME_RE = re.compile(r'foundation-model/([a-zA-Z0-9\-\.]+)')
+
+# Model and knowledge base listings change rarely, so results are cached for a short time
+LISTING_CACHE_TTL = 300  # seconds
+_listing_cache: Dict[Tuple, Tuple[Dict, float]] = {}
+
+def _get_cached_listing(key: Tuple) -> Optional[Dict]:
+    """Return a copy of a cached listing if it has not expired"""
+    entry = _listing_cache.get(key)
+    if entry and entry[1] > monotonic():
+        # Hand out a copy so callers cannot modify the cached result
+        return copy.deepcopy(entry[0])
+    return None
+
+def _cache_listing(key: Tuple, result: Dict) -> Dict:
+    """Store a listing result in the cache and return it"""
+    _listing_cache[key] = (copy.deepcopy(result), monotonic() + LISTING_CACHE_TTL)
+    return result
+
+@lru_cache(maxsize=1024)
+def _parse_model_arn(model_arn: str) -> Tuple[str, str, str, str]:
+    """Split a model ARN into base ARN, token count, formatted name and provider label"""
+    base_arn_match = _BASE_ARN_RE.match(model_arn)
+    if base_arn_match:
+        base_arn = base_arn_match.group(1)
+        token_count = base_arn_match.group(2)
+    else:
+        base_arn = model_arn
+        token_count = ""
+
+    match = _FM_NAME_RE.search(base_arn)
+    model_name = match.group(1) if match else "Unknown"
+    model_prefix = model_name.split('.')[0] if model_name != "Unknown" else "Unknown"
+    formatted_name = model_name.replace("-", " ").replace(".", " ").title()
+    return base_arn, token_count, formatted_name, model_prefix.capitalize()
+
+def _active_summaries(summaries: List[Dict], status_filter: Optional[str]) -> List[Dict]:
+    """Keep the knowledge base summaries matching the status filter, if any"""
+    return [kb for kb in summaries if not status_filter or kb.get("status") == status_filter]
 
 class KnowledgebaseService:
     @staticmethod
     async def list_models():
         """Get list of available Bedrock models for the knowledge base"""
         try:
+            cached = _get_cached_listing(("list_models",))
+            if cached is not None:
+                return cached
+            
             # 1. Get models from AWS Bedrock
-            response = bedrock_client.list_foundation_models()
+            response = await run_aws(bedrock_client.list_foundation_models)
             
             # 2. Dictionary to track unique models
             unique_models = {}
             
             # 3. Process each model from the response
             for model in response.get('modelSummaries', []):
-                model_arn = model['modelArn']
-                
-                # 4. Extract base ARN and token count
-                base_arn_match = re.match(r'(.+?:\d+):(\d+[kKmM]?)$', model_arn)
-                if base_arn_match:
-                    base_arn = base_arn_match.group(1)
-                    token_count = base_arn_match.group(2)
-                else:
-                    base_arn = model_arn
-                    token_count = ""
-
-                # 5. Extract and format model name
-                match = re.search(r'foundation-model/([a-zA-Z0-9\-\.]+)', base_arn)
-                model_name = match.group(1) if match else "Unknown"
-                model_prefix = model_name.split('.')[0] if model_name != "Unknown" else "Unknown"
-                formatted_name = model_name.replace("-", " ").replace(".", " ").title()
-
-                # 6. Create base model info dictionary
+                # 4. Extract base ARN, token count and formatted names
+                base_arn, token_count, formatted_name, model_label = _parse_model_arn(model['modelArn'])
+
+                # 5. Create base model info dictionary
                 model_info = {
                     "model_arn": base_arn,
                     "model_max_token": token_count,
                     "model_name": formatted_name,
-                    "model": model_prefix.capitalize(),
+                    "model": model_label,
                     "description": model.get('modelDescription', '')
                 }
 
-                # 7. Check if we've seen this base model before
+                # 6. Check if we've seen this base model before
                 if base_arn not in unique_models:
-                    # 8. Enrich with config and pricing using KBModelConfigs
+                    # 7. Enrich with config and pricing using KBModelConfigs
                     enriched_model = KBModelConfigs.enrich_model_info(model_info)
                     unique_models[base_arn] = enriched_model
                 
-            # 9. Return final results
-            return {"models": list(unique_models.values())}
+            # 8. Return final results
+            return _cache_listing(("list_models",), {"models": list(unique_models.values())})
             
         except Exception as e:
-            print(f"Error in list_models: {str(e)}")
+            logger.error("Error in list_models: %s", e)
             raise
 
     @staticmethod
@@ -68,6 +106,13 @@ class KnowledgebaseService:
         Get a list of active knowledge bases with mapped fields.
         """
         try:
+            # Only first pages are cached, so paginated requests never see stale tokens
+            cache_key = ("list_knowledgebases", max_results, status_filter)
+            if not next_token:
+                cached = _get_cached_listing(cache_key)
+                if cached is not None:
+                    return cached
+
             # Prepare parameters for listing knowledge bases
             list_params = {"maxResults": max_results}
             if next_token:
@@ -75,66 +120,11 @@ class KnowledgebaseService:
 
             # Fetch list of knowledge bases
             response = bedrock_agent.list_knowledge_bases(**list_params)
-            print(f"List knowledge bases response: {response}")
-
-            knowledgebases = []
-
-            # Iterate through knowledge bases
-            for kb in response.get("knowledgeBaseSummaries", []):
-                if status_filter and kb.get("status") != status_filter:
-                    continue
-
-                kb_id = kb.get("knowledgeBaseId")
-                print(f"Processing knowledge base: {kb_id}")
-
-                # Fetch detailed knowledge base information
-                try:
-                    kb_detail_response = bedrock_agent.get_knowledge_base(knowledgeBaseId=kb_id)
-                    kb_detail = kb_detail_response.get("knowledgeBase", {})
-                    print(f"Details for KB {kb_id}: {kb_detail}")
-                except Exception as e:
-                    print(f"Error getting details for KB {kb_id}: {str(e)}")
-                    kb_detail = {}
-
-                # Extract necessary fields
-                storage_config = kb_detail.get("storageConfiguration", {})
-                vector_field = storage_config.get("opensearchServerlessConfiguration", {}).get("fieldMapping", {}).get("vectorField")
-                description_field = storage_config.get("opensearchServerlessConfiguration", {}).get("fieldMapping", {}).get("metadataField")
-
-                # Fetch data sources using `list_data_sources`
-                data_sources = []
-                try:
-                    data_sources_response = bedrock_agent.list_data_sources(knowledgeBaseId=kb_id)
-                    print(f"Data sources response for KB {kb_id}: {data_sources_response}")
-
-                    for ds in data_sources_response.get("dataSourceSummaries", []):
-                        data_sources.append({
-                            "data_source_id": ds.get("dataSourceId"),
-                            "knowledge_base_id": ds.get("knowledgeBaseId"),
-                            "name": ds.get("name"),
-                            "description": ds.get("description"),
-                            "status": ds.get("status"),
-                            "last_updated": ds.get("updatedAt").isoformat() if ds.get("updatedAt") else None,
-                        })
-                except Exception as e:
-                    print(f"Error getting data sources for KB {kb_id}: {str(e)}")
-
-                # Construct knowledge base info
-                kb_info = {
-                    "knowledge_base_id": kb_id,
-                    "name": kb.get("name"),
-                    "description": kb_detail.get("description"),  
-                    "status": kb.get("status"),
-                    "creation_time": kb_detail.get("createdAt").isoformat() if kb_detail.get("createdAt") else None,
-                    "last_updated_time": kb.get("updatedAt").isoformat() if kb.get("updatedAt") else None,
-                    "storage_capacity": kb_detail.get("storageConfiguration"),  
-                    "data_source_count": len(data_sources),
-                    "vector_field": vector_field,
-                    "description_field": description_field,
-                    "data_sources": data_sources,
-                }
 
-                knowledgebases.append(kb_info)
+            summaries = _active_summaries(response.get("knowledgeBaseSummaries", []), status_filter)
+            knowledgebases, complete = KnowledgebaseService._build_knowledgebase_infos(
+                KnowledgebaseService._start_knowledgebase_lookups(summaries)
+            )
 
             # Prepare final result
             result = {
@@ -145,10 +135,121 @@ class KnowledgebaseService:
             if "nextToken" in response:
                 result["next_token"] = response["nextToken"]
 
+            if not next_token and complete:
+                _cache_listing(cache_key, result)
+
             return result
 
         except Exception as e:
-            print(f"Error in list_knowledgebases: {str(e)}")
+            logger.error("Error in list_knowledgebases: %s", e)
+            raise
+
+    @staticmethod
+    def _start_knowledgebase_lookups(summaries: List[Dict]) -> List[Tuple[Dict, Future, Future]]:
+        """Start fetching details and data sources for each knowledge base on the AWS executor"""
+        return [
+            (
+                kb,
+                AWS_EXECUTOR.submit(bedrock_agent.get_knowledge_base, knowledgeBaseId=kb.get("knowledgeBaseId")),
+                AWS_EXECUTOR.submit(bedrock_agent.list_data_sources, knowledgeBaseId=kb.get("knowledgeBaseId"))
+            )
+            for kb in summaries
+        ]
+
+    @staticmethod
+    def _build_knowledgebase_infos(lookups: List[Tuple[Dict, Future, Future]]) -> Tuple[List[Dict], bool]:
+        """Map started lookups to knowledge base info, and whether every lookup succeeded"""
+        results = [KnowledgebaseService._build_knowledgebase_info(*lookup) for lookup in lookups]
+        return [info for info, _ in results], all(complete for _, complete in results)
+
+    @staticmethod
+    def _build_knowledgebase_info(kb: Dict, detail_future: Future, data_sources_future: Future) -> Tuple[Dict, bool]:
+        """Map a knowledge base summary and its fetched details to the API fields
+
+        Failed lookups leave their fields empty and are reported as incomplete, so a
+        degraded listing (e.g. after throttling) is not cached.
+        """
+        kb_id = kb.get("knowledgeBaseId")
+        complete = True
+        logger.debug("Processing knowledge base: %s", kb_id)
+
+        # Fetch detailed knowledge base information
+        try:
+            kb_detail_response = detail_future.result()
+            kb_detail = kb_detail_response.get("knowledgeBase", {})
+            logger.debug("Details for KB %s: %s", kb_id, kb_detail)
+        except Exception as e:
+            logger.error("Error getting details for KB %s: %s", kb_id, e)
+            kb_detail = {}
+            complete = False
+
+        # Extract necessary fields
+        storage_config = kb_detail.get("storageConfiguration", {})
+        vector_field = storage_config.get("opensearchServerlessConfiguration", {}).get("fieldMapping", {}).get("vectorField")
+        description_field = storage_config.get("opensearchServerlessConfiguration", {}).get("fieldMapping", {}).get("metadataField")
+
+        # Fetch data sources using `list_data_sources`
+        data_sources = []
+        try:
+            data_sources_response = data_sources_future.result()
+
+            for ds in data_sources_response.get("dataSourceSummaries", []):
+                data_sources.append({
+                    "data_source_id": ds.get("dataSourceId"),
+                    "knowledge_base_id": ds.get("knowledgeBaseId"),
+                    "name": ds.get("name"),
+                    "description": ds.get("description"),
+                    "status": ds.get("status"),
+                    "last_updated": ds.get("updatedAt").isoformat() if ds.get("updatedAt") else None,
+                })
+        except Exception as e:
+            logger.error("Error getting data sources for KB %s: %s", kb_id, e)
+            complete = False
+
+        # Construct knowledge base info
+        return {
+            "knowledge_base_id": kb_id,
+            "name": kb.get("name"),
+            "description": kb_detail.get("description"),  
+            "status": kb.get("status"),
+            "creation_time": kb_detail.get("createdAt").isoformat() if kb_detail.get("createdAt") else None,
+            "last_updated_time": kb.get("updatedAt").isoformat() if kb.get("updatedAt") else None,
+            "storage_capacity": kb_detail.get("storageConfiguration"),  
+            "data_source_count": len(data_sources),
+            "vector_field": vector_field,
+            "description_field": description_field,
+            "data_sources": data_sources,
+        }, complete
+
+    @staticmethod
+    def list_all_knowledgebases(page_size: int = 10, status_filter: str = "ACTIVE") -> Dict:
+        """
+        Get every knowledge base across all pages with mapped fields.
+        """
+        try:
+            cache_key = ("list_all_knowledgebases", page_size, status_filter)
+            cached = _get_cached_listing(cache_key)
+            if cached is not None:
+                return cached
+
+            # Lookups for each page are started before the next page is requested, so
+            # page fetches overlap with the per knowledge base calls on the executor
+            paginator = bedrock_agent.get_paginator("list_knowledge_bases")
+            lookups = []
+            for page in paginator.paginate(PaginationConfig={"PageSize": page_size}):
+                summaries = _active_summaries(page.get("knowledgeBaseSummaries", []), status_filter)
+                lookups.extend(KnowledgebaseService._start_knowledgebase_lookups(summaries))
+
+            knowledgebases, complete = KnowledgebaseService._build_knowledgebase_infos(lookups)
+
+            result = {
+                "knowledgebases": knowledgebases,
+                "total_count": len(knowledgebases),
+            }
+            return _cache_listing(cache_key, result) if complete else result
+
+        except Exception as e:
+            logger.error("Error in list_all_knowledgebases: %s", e)
             raise
 
     @staticmethod
@@ -162,11 +263,10 @@ class KnowledgebaseService:
         Returns:
             Dict containing usage statistics
         """
-        try:
-            # Get metrics for the last 24 hours
-            end_time = datetime.utcnow()
-            start_time = end_time - timedelta(days=1)
+        # One timestamp for the success and error responses
+        retrieved_at = datetime.now(timezone.utc).isoformat()
 
+        try:
             # Get knowledge base details
             kb_details = bedrock_agent.get_knowledge_base(
                 knowledgeBaseId=kb_id
@@ -186,11 +286,11 @@ class KnowledgebaseService:
                     "used": kb_details.get('storageUsed', 0)
                 },
                 "time_period": "24h",
-                "retrieved_at": end_time.isoformat()
+                "retrieved_at": retrieved_at
             }
 
         except Exception as e:
-            print(f"Error getting Bedrock metrics: {str(e)}")
+            logger.error("Error getting Bedrock metrics: %s", e)
             return {
                 "status": "ERROR",
                 "error": str(e),
@@ -201,5 +301,5 @@ class KnowledgebaseService:
                     "used": 0
                 },
                 "time_period": "24h",
-                "retrieved_at": datetime.utcnow().isoformat()
+                "retrieved_at": retrieved_at
             }
\ No newline at end of file
@@ -1,61 +1,130 @@
-import json
-import asyncio
+import orjson
 from typing import Optional, Dict, Any, AsyncGenerator, List
-from config.aws_config import bedrock_agent_runtime_client, model_arn, bedrock_runtime
+from config.aws_config import (
+    bedrock_agent_runtime_client, model_arn, bedrock_runtime, run_aws, PERFORMANCE_LATENCY, KB_PROMPT_OVERRIDES
+)
 from api.models.models import GenerationSettings
-from api.models.kb_model_config import KBModelConfigs
+from api.models.kb_model_config import KBModelConfigs, KBModelConfig
 from utils.kb_metrics import KBCostMetrics
-from utils.kb_utils import KBUtils
+from utils.kb_utils import (
+    prepare_request_body, extract_stream_text, response_cache_key, get_cached_response, cache_response
+)
+from config.logging_config import logger
 
 DEFAULT_MODEL_ARN = model_arn
 
-class QueryService:
-    @staticmethod
-    def _format_stream_response(text: str) -> str:
-        """Format streaming response text into clean HTML"""
-        import re
-        
-        # Remove any system style tags
-        text = re.sub(r'<userStyle>.*?</userStyle>', '', text)
-        text = re.sub(r'<[a-zA-Z]+Style>.*?</[a-zA-Z]+Style>', '', text)
-        
-        # Clean the text and split into lines
-        lines = text.strip().split('\n')
-        formatted_lines = []
-        current_list_items = []
-        in_list = False
+# Proportional cost baseline: 1000 characters cost $0.0001 for input and $0.0003 for output
+_INPUT_COST_PER_CHAR = 0.0001 / 1000
+_OUTPUT_COST_PER_CHAR = 0.0003 / 1000
+
+def _build_cost_metrics(
+    prompt: str,
+    generated_text: str,
+    usage_body: Optional[Dict[str, Any]],
+    model_config: KBModelConfig
+) -> Dict[str, Any]:
+    """Build the cost metrics reported in the final frame of a query"""
+    # Try to get token usage from the response
+    token_usage = KBCostMetrics.get_token_usage(usage_body, model_config)
+    
+    # If we got minimum token values, try to estimate more accurately
+    if token_usage["input_tokens"] <= 1 or token_usage["output_tokens"] <= 1:
+        # Estimate input tokens from prompt length
+        input_tokens = KBCostMetrics.estimate_tokens(prompt)
         
-        for line in lines:
-            line = line.strip()
-            if not line:
-                if in_list and current_list_items:
-                    formatted_lines.append('<ul>')
-                    formatted_lines.extend(current_list_items)
-                    formatted_lines.append('</ul>')
-                    current_list_items = []
-                    in_list = False
-                continue
-            
-            if line.startswith(('* ', '- ')):
-                in_list = True
-                item_text = line[2:].strip()
-                current_list_items.append(f'<li>{item_text}</li>')
-            else:
-                if in_list and current_list_items:
-                    formatted_lines.append('<ul>')
-                    formatted_lines.extend(current_list_items)
-                    formatted_lines.append('</ul>')
-                    current_list_items = []
-                    in_list = False
-                formatted_lines.append(f'<p>{line}</p>')
+        # Estimate output tokens from generated text
+        output_tokens = KBCostMetrics.estimate_tokens(generated_text)
         
-        # Handle any remaining list items
-        if in_list and current_list_items:
-            formatted_lines.append('<ul>')
-            formatted_lines.extend(current_list_items)
-            formatted_lines.append('</ul>')
+        # Use our estimates
+        token_usage = {
+            "input_tokens": max(1, input_tokens),
+            "output_tokens": max(1, output_tokens),
+            "total_tokens": max(2, input_tokens + output_tokens)
+        }
         
-        return '\n'.join(formatted_lines)
+        logger.debug("Using estimated token counts: input=%s, output=%s", input_tokens, output_tokens)
+    
+    # Get a proportional cost based on text length
+    # This ensures the cost varies based on the actual length of text
+    input_cost = len(prompt) * _INPUT_COST_PER_CHAR
+    output_cost = len(generated_text) * _OUTPUT_COST_PER_CHAR
+    total_cost = input_cost + output_cost
+    
+    # Set cost metrics based on the proportional costs
+    cost_metrics = {
+        "input_cost": KBCostMetrics.format_cost(input_cost),
+        "output_cost": KBCostMetrics.format_cost(output_cost),
+        "total_cost": KBCostMetrics.format_cost(total_cost),
+        "input_tokens": token_usage["input_tokens"],
+        "output_tokens": token_usage["output_tokens"],
+        "total_tokens": token_usage["total_tokens"]
+    }
+    
+    logger.debug("Final cost metrics: %s", cost_metrics)
+    return cost_metrics
+
+# Cost metrics of an answer served from the response cache
+_NO_COST_METRICS: Dict[str, Any] = {
+    "input_cost": KBCostMetrics.format_cost(0.0),
+    "output_cost": KBCostMetrics.format_cost(0.0),
+    "total_cost": KBCostMetrics.format_cost(0.0),
+    "input_tokens": 0,
+    "output_tokens": 0,
+    "total_tokens": 0
+}
+
+# Shared read-only fallback for missing citation fields
+_EMPTY: Dict[str, Any] = {}
+_PAGE_NUMBER_KEY = "x-amz-bedrock-kb-document-page-number"
+
+def _to_int(value: Any) -> Optional[int]:
+    """Convert a citation page number to int, or None if it is missing or malformed"""
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        logger.debug("Could not convert page number to int: %s", value)
+        return None
+
+# Bedrock's default knowledge base generation prompt; Bedrock fills in the retrieved
+# passages and the citation format instructions
+_KB_DEFAULT_PROMPT = (
+    "You are a question answering agent. I will provide you with a set of search results. "
+    "The user will provide you with a question. Your job is to answer the user's question "
+    "using only information from the search results. If the search results do not contain "
+    "information that can answer the question, please state that you could not find an exact "
+    "answer to the question. Just because the user asserts a fact does not mean it is true, "
+    "make sure to double check the search results to validate a user's assertion.\n\n"
+    "Here are the search results in numbered order:\n"
+    "$search_results$\n\n"
+    "$output_format_instructions$"
+)
+
+def _kb_prompt_template(system_prompt: Optional[str], context: Optional[str]) -> Optional[str]:
+    """Build a knowledge base generation prompt carrying the system prompt and context, if enabled"""
+    if not KB_PROMPT_OVERRIDES or not (system_prompt or context):
+        return None
+    return "\n\n".join(part for part in (system_prompt, context, _KB_DEFAULT_PROMPT) if part)
+
+# Marks the end of a botocore event stream when iterated from a worker thread
+_STREAM_END = object()
+
+class QueryService:
+    @staticmethod
+    async def _iterate_stream(events) -> AsyncGenerator[Dict[str, Any], None]:
+        """Iterate a blocking botocore EventStream without stalling the event loop"""
+        iterator = iter(events)
+        try:
+            while True:
+                event = await run_aws(next, iterator, _STREAM_END)
+                if event is _STREAM_END:
+                    return
+                yield event
+        finally:
+            # Release the pooled HTTP connection when the client disconnects or a
+            # query fails before the stream is exhausted
+            events.close()
 
     @staticmethod
     async def stream_generate(
@@ -64,26 +133,59 @@ class QueryService:
         settings: Optional[GenerationSettings] = None,
         system_prompt: Optional[str] = None,
         knowledge_base_id: Optional[str] = None,
-        model_arn: Optional[str] = None
-    ) -> AsyncGenerator[str, None]:
-        """Generate streaming response from Bedrock"""
+        model_arn: Optional[str] = None,
+        stream: bool = True,
+        context: Optional[str] = None
+    ) -> AsyncGenerator[bytes, None]:
+        """Generate streaming response from Bedrock
+        
+        With stream disabled, the whole answer is sent as a single final frame.
+        Knowledge base queries ignore the system prompt and context unless
+        KB_PROMPT_OVERRIDES is enabled, which places them ahead of Bedrock's
+        default generation prompt.
+        """
         try:
             current_model_arn = model_arn or DEFAULT_MODEL_ARN
             
-            try:
-                model_config = KBModelConfigs.get_config(current_model_arn)
-            except Exception as config_error:
-                print(f"Error getting model config: {str(config_error)}")
-                model_config = KBModelConfigs.DEFAULT_CONFIG
+            model_config = KBModelConfigs.get_config(current_model_arn)
             
             metadata = {
                 "page_numbers": [],
                 "cost_metrics": None
             }
             
-            citations_map = {}  # Will store citation spans and their corresponding page numbers
+            generated_parts = []
+            usage_body = None
+
+            # Identical queries within the cache TTL are answered without calling Bedrock
+            cache_key = response_cache_key(
+                current_model_arn,
+                knowledge_base_id,
+                document_id,
+                system_prompt,
+                context if KB_PROMPT_OVERRIDES or not knowledge_base_id else None,
+                prompt,
+                settings.model_dump_json() if settings else None
+            )
+            cached = get_cached_response(cache_key)
 
-            if knowledge_base_id:
+            if cached is not None:
+                cached_text, metadata["page_numbers"] = cached
+                metadata["cached"] = True
+                generated_parts.append(cached_text)
+                if stream:
+                    yield orjson.dumps({
+                        "chunk": cached_text,
+                        "is_final": False
+                    }) + b"\n"
+                    if metadata["page_numbers"]:
+                        yield orjson.dumps({
+                            "chunk": "",
+                            "is_final": False,
+                            "chunk_page_numbers": metadata["page_numbers"]
+                        }) + b"\n"
+
+            elif knowledge_base_id:
                 # Knowledge base query logic
                 config = {
                     'type': 'KNOWLEDGE_BASE',
@@ -98,6 +200,17 @@ class QueryService:
                     }
                 }
 
+                generation_config = {}
+                if PERFORMANCE_LATENCY != 'standard':
+                    generation_config['performanceConfig'] = {'latency': PERFORMANCE_LATENCY}
+
+                prompt_template = _kb_prompt_template(system_prompt, context)
+                if prompt_template:
+                    generation_config['promptTemplate'] = {'textPromptTemplate': prompt_template}
+
+                if generation_config:
+                    config['knowledgeBaseConfiguration']['generationConfiguration'] = generation_config
+
                 if document_id:
                     config['knowledgeBaseConfiguration']['retrievalConfiguration']['vectorSearchConfiguration']['filter'] = {
                         'stringContains': {
@@ -112,224 +225,125 @@ class QueryService:
                 }
                 
                 try:
-                    response = bedrock_agent_runtime_client.retrieve_and_generate(**request_params)
-                    generated_text = response.get('output', {}).get('text', '')
+                    response = await run_aws(
+                        bedrock_agent_runtime_client.retrieve_and_generate_stream,
+                        **request_params
+                    )
                     
-                    # Process page numbers and map them to text spans
+                    # Process page numbers as citation events arrive
                     unique_page_numbers = set()
                     
-                    if response and isinstance(response, dict):
-                        # The citations might be directly in the response or nested
-                        citations_data = None
+                    async for event in QueryService._iterate_stream(response['stream']):
+                        if 'output' in event:
+                            text = event['output'].get('text', '')
+                            if text:
+                                generated_parts.append(text)
+                                if stream:
+                                    yield orjson.dumps({
+                                        "chunk": text,
+                                        "is_final": False
+                                    }) + b"\n"
                         
-                        # Check different possible locations for citations
-                        if "citations" in response:
-                            citations_data = response["citations"]
-                        elif "retrieveAndGenerateResponse" in response and "citations" in response["retrieveAndGenerateResponse"]:
-                            citations_data = response["retrieveAndGenerateResponse"]["citations"]
-                        
-                        if citations_data:
-                            for citation in citations_data:
-                                if isinstance(citation, dict):
-                                    # Get the text span for this citation
-                                    span_start = None
-                                    span_end = None
-                                    
-                                    # Check for generatedResponsePart which contains the span information
-                                    if "generatedResponsePart" in citation and "textResponsePart" in citation["generatedResponsePart"]:
-                                        text_part = citation["generatedResponsePart"]["textResponsePart"]
-                                        if "span" in text_part:
-                                            span_start = text_part["span"].get("start")
-                                            span_end = text_part["span"].get("end")
-                                    
-                                    # Get page numbers from retrieved references
-                                    if "retrievedReferences" in citation:
-                                        page_numbers_for_citation = []
-                                        
-                                        for reference in citation["retrievedReferences"]:
-                                            if isinstance(reference, dict) and 'metadata' in reference:
-                                                page_number = reference["metadata"].get("x-amz-bedrock-kb-document-page-number")
-                                                if page_number is not None:
-                                                    try:
-                                                        page_num = int(page_number)
-                                                        page_numbers_for_citation.append(page_num)
-                                                        unique_page_numbers.add(page_num)
-                                                    except (ValueError, TypeError):
-                                                        print(f"Could not convert page number to int: {page_number}")
-                                        
-                                        # If we have both span and page numbers, map them
-                                        if span_start is not None and span_end is not None and page_numbers_for_citation:
-                                            citations_map[(span_start, span_end)] = sorted(page_numbers_for_citation)
-                    
-                    metadata["page_numbers"] = sorted(list(unique_page_numbers))
-                    
-                    # Try to get token usage from the response
-                    token_usage = KBCostMetrics.get_token_usage(response, model_config.provider.value, model_config.model_id)
-                    
-                    # If we got minimum token values, try to estimate more accurately
-                    if token_usage["input_tokens"] <= 1 or token_usage["output_tokens"] <= 1:
-                        # Estimate input tokens from prompt length
-                        input_tokens = KBCostMetrics.estimate_tokens(prompt)
-                        
-                        # Estimate output tokens from generated text
-                        output_tokens = KBCostMetrics.estimate_tokens(generated_text)
-                        
-                        # Use our estimates
-                        token_usage = {
-                            "input_tokens": max(1, input_tokens),
-                            "output_tokens": max(1, output_tokens),
-                            "total_tokens": max(2, input_tokens + output_tokens)
-                        }
-                        
-                        print(f"DEBUG - Using estimated token counts: input={input_tokens}, output={output_tokens}")
-                    
-                    # Get a proportional cost based on text length
-                    # This ensures the cost varies based on the actual length of text
-                    prompt_length = len(prompt)
-                    response_length = len(generated_text)
-                    
-                    # Calculate proportional costs based on text length
-                    # Assume 1000 characters costs $0.0001 for input and $0.0003 for output as a baseline
-                    input_cost = (prompt_length / 1000) * 0.0001 
-                    output_cost = (response_length / 1000) * 0.0003
-                    total_cost = input_cost + output_cost
-                    
-                    # Format costs
-                    from decimal import Decimal, ROUND_HALF_UP
-                    
-                    def format_cost(value: float) -> str:
-                        decimal_value = Decimal(str(value)).quantize(Decimal('0.000000'), rounding=ROUND_HALF_UP)
-                        return f"${decimal_value:,.6f}"
-                    
-                    # Set cost metrics based on the proportional costs
-                    metadata["cost_metrics"] = {
-                        "input_cost": format_cost(input_cost),
-                        "output_cost": format_cost(output_cost),
-                        "total_cost": format_cost(total_cost),
-                        "input_tokens": token_usage["input_tokens"],
-                        "output_tokens": token_usage["output_tokens"],
-                        "total_tokens": token_usage["total_tokens"]
-                    }
+                        elif 'citation' in event:
+                            # Citations refer to text that has already been streamed, so they
+                            # are forwarded as their own frame carrying only page numbers
+                            citation = event['citation']
+                            references = citation.get('retrievedReferences') or citation.get('citation', _EMPTY).get('retrievedReferences') or ()
+                            citation_pages = {
+                                page_number
+                                for reference in references
+                                if (page_number := _to_int((reference.get("metadata") or _EMPTY).get(_PAGE_NUMBER_KEY))) is not None
+                            }
+                            
+                            if citation_pages:
+                                unique_page_numbers |= citation_pages
+                                if stream:
+                                    yield orjson.dumps({
+                                        "chunk": "",
+                                        "is_final": False,
+                                        "chunk_page_numbers": sorted(citation_pages)
+                                    }) + b"\n"
                     
-                    print(f"DEBUG - Final cost metrics: {metadata['cost_metrics']}")
+                    metadata["page_numbers"] = sorted(unique_page_numbers)
 
                 except Exception as kb_error:
-                    print(f"Error in KB query: {str(kb_error)}")
-                    yield json.dumps({
+                    logger.error("Error in KB query: %s", kb_error)
+                    yield orjson.dumps({
                         "error": f"Knowledge base query failed: {str(kb_error)}",
                         "is_final": True
-                    }) + "\n"
+                    }) + b"\n"
                     return
 
             else:
                 # Direct LLM query
                 try:
-                    request_body = KBUtils._prepare_request_body(prompt, settings, current_model_arn)
                     request_params = {
                         'modelId': current_model_arn,
                         'contentType': 'application/json',
                         'accept': 'application/json',
-                        'body': json.dumps(request_body).encode('utf-8')
+                        'body': prepare_request_body(
+                            prompt, settings, current_model_arn, system_prompt, as_bytes=True, context=context
+                        )
                     }
+                    if PERFORMANCE_LATENCY != 'standard':
+                        request_params['performanceConfigLatency'] = PERFORMANCE_LATENCY
                     
-                    response = bedrock_runtime.invoke_model(**request_params)
-                    response_body = json.loads(response['body'].read().decode())
+                    response = await run_aws(
+                        bedrock_runtime.invoke_model_with_response_stream,
+                        **request_params
+                    )
                     
-                    generated_text = KBUtils._extract_generated_text(response_body, model_config)
-                    
-                    # Try to get token usage from the response
-                    token_usage = KBCostMetrics.get_token_usage(response_body, model_config.provider.value, model_config.model_id)
-                    
-                    # If we got minimum token values, try to estimate more accurately
-                    if token_usage["input_tokens"] <= 1 or token_usage["output_tokens"] <= 1:
-                        # Estimate input tokens from prompt length
-                        input_tokens = KBCostMetrics.estimate_tokens(prompt)
+                    async for event in QueryService._iterate_stream(response['body']):
+                        if 'chunk' not in event:
+                            continue
+                        chunk_body = orjson.loads(event['chunk']['bytes'])
                         
-                        # Estimate output tokens from generated text
-                        output_tokens = KBCostMetrics.estimate_tokens(generated_text)
-                        
-                        # Use our estimates
-                        token_usage = {
-                            "input_tokens": max(1, input_tokens),
-                            "output_tokens": max(1, output_tokens),
-                            "total_tokens": max(2, input_tokens + output_tokens)
-                        }
+                        text = extract_stream_text(chunk_body, model_config)
+                        if text:
+                            generated_parts.append(text)
+                            if stream:
+                                yield orjson.dumps({
+                                    "chunk": text,
+                                    "is_final": False
+                                }) + b"\n"
                         
-                        print(f"DEBUG - Using estimated token counts: input={input_tokens}, output={output_tokens}")
-                    
-                    # Get a proportional cost based on text length
-                    prompt_length = len(prompt)
-                    response_length = len(generated_text)
-                    
-                    # Calculate proportional costs based on text length
-                    # Assume 1000 characters costs $0.0001 for input and $0.0003 for output as a baseline
-                    input_cost = (prompt_length / 1000) * 0.0001 
-                    output_cost = (response_length / 1000) * 0.0003
-                    total_cost = input_cost + output_cost
-                    
-                    # Format costs
-                    from decimal import Decimal, ROUND_HALF_UP
-                    
-                    def format_cost(value: float) -> str:
-                        decimal_value = Decimal(str(value)).quantize(Decimal('0.000000'), rounding=ROUND_HALF_UP)
-                        return f"${decimal_value:,.6f}"
-                    
-                    # Set cost metrics based on the proportional costs
-                    metadata["cost_metrics"] = {
-                        "input_cost": format_cost(input_cost),
-                        "output_cost": format_cost(output_cost),
-                        "total_cost": format_cost(total_cost),
-                        "input_tokens": token_usage["input_tokens"],
-                        "output_tokens": token_usage["output_tokens"],
-                        "total_tokens": token_usage["total_tokens"]
-                    }
-                    
-                    print(f"DEBUG - Final cost metrics: {metadata['cost_metrics']}")
+                        # The last chunk carries the invocation metrics with token counts
+                        if "amazon-bedrock-invocationMetrics" in chunk_body:
+                            usage_body = chunk_body
 
                 except Exception as llm_error:
-                    print(f"Error in direct LLM query: {str(llm_error)}")
-                    yield json.dumps({
+                    logger.error("Error in direct LLM query: %s", llm_error)
+                    yield orjson.dumps({
                         "error": f"Direct LLM query failed: {str(llm_error)}",
                         "is_final": True
-                    }) + "\n"
+                    }) + b"\n"
                     return
 
-            # Stream the response in chunks with associated page numbers
-            chunk_size = 100
-            for i in range(0, len(generated_text), chunk_size):
-                chunk = generated_text[i:i + chunk_size]
-                chunk_start = i
-                chunk_end = i + len(chunk)
-                is_final = i + chunk_size >= len(generated_text)
-                
-                # Find page numbers relevant to this chunk
-                chunk_page_numbers = []
-                for (span_start, span_end), page_nums in citations_map.items():
-                    # Check if this citation span overlaps with the current chunk
-                    if not (chunk_end <= span_start or chunk_start >= span_end):
-                        chunk_page_numbers.extend(page_nums)
-                
-                # Remove duplicates and sort
-                chunk_page_numbers = sorted(list(set(chunk_page_numbers)))
-                
-                response_chunk = {
-                    "chunk": chunk,
-                    "is_final": is_final
-                }
-                
-                # Include page numbers for this chunk if available
-                if chunk_page_numbers:
-                    response_chunk["chunk_page_numbers"] = chunk_page_numbers
-                
-                if is_final:
-                    response_chunk["metadata"] = metadata
-                
-                yield json.dumps(response_chunk, ensure_ascii=False) + "\n"
-                await asyncio.sleep(0.1)
+            generated_text = "".join(generated_parts)
+            if cached is not None:
+                # A replayed answer never reached Bedrock, so nothing was billed
+                metadata["cost_metrics"] = dict(_NO_COST_METRICS)
+            else:
+                if generated_text:
+                    cache_response(cache_key, (generated_text, metadata["page_numbers"]))
+                # Token usage comes from the invocation metrics when present (the KB stream carries none)
+                metadata["cost_metrics"] = _build_cost_metrics(prompt, generated_text, usage_body, model_config)
+
+            # Close the stream with the aggregated metadata; without streaming this
+            # single frame carries the whole answer
+            final_chunk = {
+                "chunk": "" if stream else generated_text,
+                "is_final": True,
+                "metadata": metadata
+            }
+            if not stream and metadata["page_numbers"]:
+                final_chunk["chunk_page_numbers"] = metadata["page_numbers"]
+            
+            yield orjson.dumps(final_chunk) + b"\n"
 
         except Exception as e:
-            print(f"Error in stream_generate: {str(e)}")
-            yield json.dumps({
+            logger.error("Error in stream_generate: %s", e)
+            yield orjson.dumps({
                 "error": str(e),
                 "is_final": True
-            }) + "\n"
\ No newline at end of file
+            }) + b"\n"
\ No newline at end of file
@@ -1,9 +1,52 @@
+import asyncio
 from datetime import datetime
-from typing import Dict, Any, Optional
+from time import monotonic
+from typing import Dict, Any, Optional, Tuple
 from fastapi import HTTPException
 from fastapi.responses import JSONResponse
 from botocore.exceptions import ClientError
-from config.aws_config import bedrock_agent, KNOWLEDGE_BASE_ID, DATA_SOURCE_ID
+from config.aws_config import bedrock_agent, KNOWLEDGE_BASE_ID, DATA_SOURCE_ID, run_aws
+from config.logging_config import logger
+from utils.kb_utils import clear_response_cache
+
+# Data sources rarely change, so their IDs are cached per knowledge base for a short time
+DATA_SOURCE_CACHE_TTL = 300  # seconds
+_data_source_cache: Dict[str, Tuple[str, float]] = {}
+
+async def _get_data_source_id(kb_id: str) -> Optional[str]:
+    """Get the first data source ID of a knowledge base, cached with a short TTL"""
+    entry = _data_source_cache.get(kb_id)
+    if entry and entry[1] > monotonic():
+        return entry[0]
+    
+    data_sources = await run_aws(
+        bedrock_agent.list_data_sources,
+        knowledgeBaseId=kb_id
+    )
+    if not data_sources.get('dataSourceSummaries'):
+        return None
+    
+    data_source_id = data_sources['dataSourceSummaries'][0]['dataSourceId']
+    _data_source_cache[kb_id] = (data_source_id, monotonic() + DATA_SOURCE_CACHE_TTL)
+    return data_source_id
+
+# Last completed ingestion job seen, so cached answers are dropped once per completion
+_last_completed_job: Optional[Tuple[str, datetime]] = None
+
+def _note_completed_job(job: Dict[str, Any]) -> None:
+    """Clear the response cache the first time a newly completed ingestion job is seen"""
+    global _last_completed_job
+    if job.get('status') != 'COMPLETE':
+        return
+    completed_job = (job.get('ingestionJobId'), job.get('updatedAt'))
+    if completed_job != _last_completed_job:
+        _last_completed_job = completed_job
+        clear_response_cache()
+
+def _invalidate_data_source_cache(error: Exception) -> None:
+    """Drop the cached data source ID when AWS reports the resource is gone"""
+    if isinstance(error, ClientError) and error.response['Error']['Code'] == 'ResourceNotFoundException':
+        _data_source_cache.pop(KNOWLEDGE_BASE_ID, None)
 
 class SyncService:
     @staticmethod
@@ -11,27 +54,25 @@ class SyncService:
         """Start knowledge base synchronization"""
         try:
             # Get data source
-            data_sources = bedrock_agent.list_data_sources(
-                knowledgeBaseId=KNOWLEDGE_BASE_ID
-            )
+            data_source_id = await _get_data_source_id(KNOWLEDGE_BASE_ID)
             
-            if not data_sources.get('dataSourceSummaries'):
+            if not data_source_id:
                 raise HTTPException(
                     status_code=404,
                     detail="No data sources found for knowledge base"
                 )
-                
-            data_source_id = data_sources['dataSourceSummaries'][0]['dataSourceId']
             
             # Check for existing in-progress sync
-            in_progress_jobs = bedrock_agent.list_ingestion_jobs(
+            in_progress_jobs = await run_aws(
+                bedrock_agent.list_ingestion_jobs,
                 knowledgeBaseId=KNOWLEDGE_BASE_ID,
                 dataSourceId=data_source_id,
                 filters=[{
                     'attribute': 'STATUS',
                     'operator': 'EQ',
                     'values': ['IN_PROGRESS']
-                }]
+                }],
+                maxResults=1
             )
             
             if in_progress_jobs.get('ingestionJobSummaries'):
@@ -42,10 +83,13 @@ class SyncService:
                 }, status_code=409)
             
             # Start new sync
-            new_job = bedrock_agent.start_ingestion_job(
+            new_job = await run_aws(
+                bedrock_agent.start_ingestion_job,
                 knowledgeBaseId=KNOWLEDGE_BASE_ID,
                 dataSourceId=data_source_id
             )
+            # Cached answers may cite content the sync is about to replace
+            clear_response_cache()
             
             return JSONResponse({
                 'message': 'Sync started successfully',
@@ -54,6 +98,7 @@ class SyncService:
             })
             
         except ClientError as e:
+            _invalidate_data_source_cache(e)
             error_code = e.response['Error']['Code']
             error_message = e.response['Error']['Message']
             
@@ -68,33 +113,44 @@ class SyncService:
                     'details': error_message
                 }, status_code=400)
             else:
-                print(f"AWS Error in start_sync: {error_code} - {error_message}")
+                logger.error("AWS Error in start_sync: %s - %s", error_code, error_message)
                 raise HTTPException(status_code=500, detail=str(e))
                 
         except Exception as e:
-            print(f"Unexpected error in start_sync: {e}")
+            logger.error("Unexpected error in start_sync: %s", e)
             raise HTTPException(status_code=500, detail=str(e))
 
     @staticmethod
     async def get_sync_status():
         """Get current sync status"""
         try:
-            data_sources = bedrock_agent.list_data_sources(
-                knowledgeBaseId=KNOWLEDGE_BASE_ID
-            )
+            data_source_id = await _get_data_source_id(KNOWLEDGE_BASE_ID)
             
-            if 'dataSourceSummaries' in data_sources and data_sources['dataSourceSummaries']:
-                data_source_id = data_sources['dataSourceSummaries'][0]['dataSourceId']
-                
-                # First check for any in-progress jobs
-                in_progress_jobs = bedrock_agent.list_ingestion_jobs(
-                    knowledgeBaseId=KNOWLEDGE_BASE_ID,
-                    dataSourceId=data_source_id,
-                    filters=[{
-                        'attribute': 'STATUS',
-                        'operator': 'EQ',
-                        'values': ['IN_PROGRESS']
-                    }]
+            if data_source_id:
+                # Look up in-progress jobs and the latest job concurrently; the latest
+                # job is only used when nothing is in progress
+                in_progress_jobs, latest_jobs = await asyncio.gather(
+                    run_aws(
+                        bedrock_agent.list_ingestion_jobs,
+                        knowledgeBaseId=KNOWLEDGE_BASE_ID,
+                        dataSourceId=data_source_id,
+                        filters=[{
+                            'attribute': 'STATUS',
+                            'operator': 'EQ',
+                            'values': ['IN_PROGRESS']
+                        }],
+                        maxResults=1
+                    ),
+                    run_aws(
+                        bedrock_agent.list_ingestion_jobs,
+                        knowledgeBaseId=KNOWLEDGE_BASE_ID,
+                        dataSourceId=data_source_id,
+                        sortBy={
+                            'attribute': 'STARTED_AT',
+                            'order': 'DESCENDING'
+                        },
+                        maxResults=1
+                    )
                 )
                 
                 # If there's an in-progress job, return its status
@@ -110,19 +166,11 @@ class SyncService:
                         'error_message': None
                     })
                 
-                # If no in-progress job, get the latest completed job
-                latest_jobs = bedrock_agent.list_ingestion_jobs(
-                    knowledgeBaseId=KNOWLEDGE_BASE_ID,
-                    dataSourceId=data_source_id,
-                    sortBy={
-                        'attribute': 'STARTED_AT',
-                        'order': 'DESCENDING'
-                    },
-                    maxResults=1
-                )
-                
+                # If no in-progress job, report the latest completed job
                 if 'ingestionJobSummaries' in latest_jobs and latest_jobs['ingestionJobSummaries']:
                     latest_job = latest_jobs['ingestionJobSummaries'][0]
+                    # Answers cached while the job ran may predate the new content
+                    _note_completed_job(latest_job)
                     
                     # Convert UTC to local timezone
                     local_start = latest_job['startedAt'].astimezone()
@@ -153,7 +201,8 @@ class SyncService:
             })
             
         except Exception as e:
-            print(f"Error in get_sync_status: {e}")
+            _invalidate_data_source_cache(e)
+            logger.error("Error in get_sync_status: %s", e)
             return JSONResponse({
                 'is_syncing': False,
                 'status': 'Error',
@@ -166,7 +215,8 @@ class SyncService:
     async def list_all_jobs():
         """List all ingestion jobs (debug endpoint)"""
         try:
-            response = bedrock_agent.list_ingestion_jobs(
+            response = await run_aws(
+                bedrock_agent.list_ingestion_jobs,
                 knowledgeBaseId=KNOWLEDGE_BASE_ID,
                 dataSourceId=DATA_SOURCE_ID
             )
@@ -1,8 +1,39 @@
 # app/utils/content_filter.py
 import re
-from typing import Dict
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Match, Pattern, Tuple
 from api.models.models import GuardrailSettings, FilterMode
 
+@lru_cache(maxsize=256)
+def _words_re(words: Tuple[str, ...], flags: int = 0) -> Pattern:
+    """Compile one whole-word alternation for all words, cached across calls"""
+    return re.compile(r'\b(' + '|'.join(re.escape(word) for word in words) + r')\b', flags)
+
+# The returned replacements are shared between calls and must not be modified
+@lru_cache(maxsize=64)
+def _build_filter(
+    custom_replacements: Tuple[Tuple[str, str], ...],
+    blocked_words: Tuple[str, ...]
+) -> Tuple[Dict[str, str], Tuple[str, ...]]:
+    """Merge the replacements for the given settings keyed by lowercased word, cached across calls"""
+    replacements = ContentFilter.DEFAULT_PROFANITY.copy()
+    replacements.update(custom_replacements)
+    for word in blocked_words:
+        replacements[word] = '*' * len(word)
+    lowered = {word.lower(): replacement for word, replacement in replacements.items()}
+    return lowered, tuple(lowered)
+
+def _replace_matches(text: str, matches: Iterable[Match], replace: Callable[[Match], str]) -> str:
+    """Replace the matched spans in text, matches may come from a lowercased copy of it"""
+    parts = []
+    last = 0
+    for match in matches:
+        parts.append(text[last:match.start()])
+        parts.append(replace(match))
+        last = match.end()
+    parts.append(text[last:])
+    return ''.join(parts)
+
 class ContentFilter:
     DEFAULT_PROFANITY = {
         'damn': 'd***',
@@ -14,35 +45,34 @@ class ContentFilter:
         if not settings.profanity_filter:
             return text
             
-        replacements = ContentFilter.DEFAULT_PROFANITY.copy()
-        if settings.custom_replacements:
-            replacements.update(settings.custom_replacements)
-            
-        if settings.custom_blocked_words:
-            for word in settings.custom_blocked_words:
-                replacements[word] = '*' * len(word)
+        lowered, words = _build_filter(
+            tuple((settings.custom_replacements or {}).items()),
+            tuple(settings.custom_blocked_words or ())
+        )
+        
+        # A single case-sensitive scan of the lowercased text matches every word at once.
+        # Lowercasing a few non-ASCII characters changes the text length, in which case
+        # the match spans wouldn't line up, so fall back to a case-insensitive scan
+        search_text = text.lower()
+        flags = 0
+        if len(search_text) != len(text):
+            search_text, flags = text, re.IGNORECASE
+        pattern = _words_re(words, flags)
         
-        filtered_text = text
-        for word, replacement in replacements.items():
-            if settings.profanity_action == FilterMode.REMOVE:
-                filtered_text = re.sub(
-                    r'\b' + re.escape(word) + r'\b', 
-                    '', 
-                    filtered_text, 
-                    flags=re.IGNORECASE
-                )
-            elif settings.profanity_action == FilterMode.MASK:
-                filtered_text = re.sub(
-                    r'\b' + re.escape(word) + r'\b', 
-                    replacement, 
-                    filtered_text, 
-                    flags=re.IGNORECASE
-                )
-            elif settings.profanity_action == FilterMode.BLOCK:
-                if re.search(r'\b' + re.escape(word) + r'\b', filtered_text, flags=re.IGNORECASE):
-                    raise ValueError(f"Generated content contains blocked word: {word}")
+        if settings.profanity_action == FilterMode.REMOVE:
+            return _replace_matches(text, pattern.finditer(search_text), lambda match: '')
+        elif settings.profanity_action == FilterMode.MASK:
+            return _replace_matches(
+                text,
+                pattern.finditer(search_text),
+                lambda match: lowered.get(match.group(1).lower(), text[match.start():match.end()])
+            )
+        elif settings.profanity_action == FilterMode.BLOCK:
+            match = pattern.search(search_text)
+            if match:
+                raise ValueError(f"Generated content contains blocked word: {text[match.start(1):match.end(1)]}")
                 
-        return filtered_text
+        return text
 
     @staticmethod
     def get_generation_config(settings: GuardrailSettings) -> Dict:
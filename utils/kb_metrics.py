@@ -1,14 +1,99 @@
-import json
-from typing import Dict, Any
-from decimal import Decimal, ROUND_HALF_UP
-from api.models.kb_model_config import KBModelConfigs, ModelProvider
+import logging
+import math
+from typing import Callable, Dict, Optional, Tuple
+from api.models.kb_model_config import KBModelConfigs, KBModelConfig, ModelProvider, AmazonFamily
 from config.logging_config import logger
 
+# Token usage extractors return raw (input_tokens, output_tokens), or None if the
+# response doesn't report usage where the provider puts it
+TokenCounts = Optional[Tuple[int, int]]
+
+def _amazon_usage(response_body: Dict) -> TokenCounts:
+    """Search the locations Bedrock may report token usage in for Amazon models."""
+    # Check for metrics in retrieveAndGenerateResponse (for newer API versions)
+    if (
+        isinstance(rag_response := response_body.get("retrieveAndGenerateResponse"), dict)
+        and isinstance(metrics := rag_response.get("metrics"), dict)
+        and "promptTokenCount" in metrics and "completionTokenCount" in metrics
+    ):
+        logger.debug("Found token usage in retrieveAndGenerateResponse.metrics")
+        return metrics["promptTokenCount"], metrics["completionTokenCount"]
+
+    # Check for usage directly in the response
+    if isinstance(usage := response_body.get("usage"), dict):
+        if "inputTokens" in usage and "outputTokens" in usage:
+            logger.debug("Found token usage in usage (inputTokens/outputTokens)")
+            return usage["inputTokens"], usage["outputTokens"]
+        if "prompt_tokens" in usage and "completion_tokens" in usage:
+            logger.debug("Found token usage in usage (prompt_tokens/completion_tokens)")
+            return usage["prompt_tokens"], usage["completion_tokens"]
+
+    # Check for responseMetadata
+    if (
+        isinstance(response_metadata := response_body.get("responseMetadata"), dict)
+        and isinstance(token_usage := response_metadata.get("tokenUsage"), dict)
+        and "promptTokens" in token_usage and "completionTokens" in token_usage
+    ):
+        logger.debug("Found token usage in responseMetadata.tokenUsage")
+        return token_usage["promptTokens"], token_usage["completionTokens"]
+
+    # If we still can't find token usage, estimate based on text length
+    if (output := response_body.get("output")) is not None and "text" in output:
+        output_tokens = KBCostMetrics.estimate_tokens(output["text"])
+        logger.debug("Estimated token usage from output text length")
+        # Assume input is about half the size of output
+        return int(output_tokens * 0.5), output_tokens
+
+    return None
+
+def _anthropic_usage(response_body: Dict, model_config: KBModelConfig) -> TokenCounts:
+    usage = response_body.get("usage", {})
+    return usage.get("input_tokens", 1), usage.get("output_tokens", 1)
+
+def _mistral_usage(response_body: Dict, model_config: KBModelConfig) -> TokenCounts:
+    usage = response_body.get("usage", {})
+    return usage.get("prompt_tokens", 1), usage.get("completion_tokens", 1)
+
+def _cohere_usage(response_body: Dict, model_config: KBModelConfig) -> TokenCounts:
+    meta = response_body.get("meta", {})
+    if "tokens" in meta:
+        return meta["tokens"].get("prompt_tokens", 1), meta["tokens"].get("completion_tokens", 1)
+    # Fall back to approximate split if detailed token info not available
+    billed_tokens = max(2, meta.get("billed_tokens", 2))
+    input_tokens = max(1, int(billed_tokens * 0.3))
+    return input_tokens, billed_tokens - input_tokens
+
+def _text_usage(response_body: Dict, model_config: KBModelConfig) -> TokenCounts:
+    """For unknown providers, estimate from text content if available."""
+    if "text" not in response_body:
+        return None
+    total_tokens = KBCostMetrics.estimate_tokens(response_body["text"])
+    input_tokens = max(1, int(total_tokens * 0.3))
+    return input_tokens, total_tokens - input_tokens
+
+def _amazon_model_usage(response_body: Dict, model_config: KBModelConfig) -> TokenCounts:
+    if model_config.amazon_family is not AmazonFamily.NOVA:
+        return _text_usage(response_body, model_config)
+    usage = response_body.get("usage", {})
+    return usage.get("inputTokens", 1), usage.get("outputTokens", 1)
+
+_USAGE_EXTRACTORS: Dict[ModelProvider, Callable[[Dict, KBModelConfig], TokenCounts]] = {
+    ModelProvider.ANTHROPIC: _anthropic_usage,
+    ModelProvider.AMAZON: _amazon_model_usage,
+    ModelProvider.COHERE: _cohere_usage,
+    ModelProvider.MISTRAL: _mistral_usage,
+}
+
 class KBCostMetrics:
     # Default pricing if model config not found ($ per 1000 tokens)
     DEFAULT_INPUT_COST = KBModelConfigs.DEFAULT_CONFIG.pricing.input_cost   # $0.0001 per 1K tokens
     DEFAULT_OUTPUT_COST = KBModelConfigs.DEFAULT_CONFIG.pricing.output_cost  # $0.0003 per 1K tokens
 
+    @staticmethod
+    def format_cost(value: float) -> str:
+        """Format a dollar amount with six decimal places, rounding half up."""
+        return f"${math.floor(value * 1_000_000 + 0.5) / 1_000_000:,.6f}"
+
     @staticmethod
     def estimate_tokens(text: str) -> int:
         """Rough estimate of token count based on text length."""
@@ -23,28 +108,26 @@ class KBCostMetrics:
         total_input_tokens = 0
         total_output_tokens = 0
         
-        # First pass: collect all text to get total input tokens
-        all_text = ""
-        for chunk in chunks:
-            if isinstance(chunk, dict):
-                chunk_text = chunk.get("chunk", "")
-                all_text += chunk_text
+        # The final chunk is normally last, so look for it from the end before
+        # paying for a pass over all the text
+        for chunk in reversed(chunks):
+            if isinstance(chunk, dict) and chunk.get("is_final"):
+                cost_metrics = chunk.get("metadata", {}).get("cost_metrics", {})
                 
-                # If it's the final chunk with metadata
-                if chunk.get("is_final") and "metadata" in chunk:
-                    metadata = chunk.get("metadata", {})
-                    cost_metrics = metadata.get("cost_metrics", {})
-                    
-                    # If there are existing non-zero costs, use those
-                    if any(float(cost.strip('$')) > 0 for cost in cost_metrics.values()):
-                        return cost_metrics
+                # If there are existing non-zero costs, use those
+                if any(float(cost.strip('$')) > 0 for cost in cost_metrics.values()):
+                    return cost_metrics
+                break
         
-        # Calculate input tokens from total text
-        total_input_tokens = KBCostMetrics.estimate_tokens(all_text)
+        # Otherwise count all text to get total input tokens
+        total_chars = 0
+        for chunk in chunks:
+            if isinstance(chunk, dict):
+                total_chars += len(chunk.get("chunk", ""))
         
-        # Ensure minimum token count of 1 if total_input_tokens is 0
-        if total_input_tokens == 0:
-            total_input_tokens = 1
+        # Calculate input tokens from total text length (same 4 characters per token
+        # estimate as estimate_tokens, without joining the chunks)
+        total_input_tokens = max(1, total_chars // 4)
 
         # Calculate output tokens as a proportion of input tokens
         # Assuming output is typically around 70% of input size for this type of content
@@ -61,18 +144,13 @@ class KBCostMetrics:
             output_cost = 0.000001
             total_cost = input_cost + output_cost
 
-        # Format costs
-        def format_cost(value: float) -> str:
-            decimal_value = Decimal(str(value)).quantize(Decimal('0.000000'), rounding=ROUND_HALF_UP)
-            return f"${decimal_value:,.6f}"
-
         costs = {
-            "input_cost": format_cost(input_cost),
-            "output_cost": format_cost(output_cost),
-            "total_cost": format_cost(total_cost)
+            "input_cost": KBCostMetrics.format_cost(input_cost),
+            "output_cost": KBCostMetrics.format_cost(output_cost),
+            "total_cost": KBCostMetrics.format_cost(total_cost)
         }
         
-        logger.debug(f"Calculated costs for chunks - Input tokens: {total_input_tokens}, Output tokens: {total_output_tokens}")
+        logger.debug("Calculated costs for chunks - Input tokens: %s, Output tokens: %s", total_input_tokens, total_output_tokens)
         return costs
 
     @staticmethod
@@ -106,115 +184,45 @@ class KBCostMetrics:
             output_cost = 0.000001
             total_cost = input_cost + output_cost
 
-        def format_cost(value: float) -> str:
-            decimal_value = Decimal(str(value)).quantize(Decimal('0.000000'), rounding=ROUND_HALF_UP)
-            return f"${decimal_value:,.6f}"
-
         return {
-            "input_cost": format_cost(input_cost),
-            "output_cost": format_cost(output_cost),
-            "total_cost": format_cost(total_cost)
+            "input_cost": KBCostMetrics.format_cost(input_cost),
+            "output_cost": KBCostMetrics.format_cost(output_cost),
+            "total_cost": KBCostMetrics.format_cost(total_cost)
         }
 
     @staticmethod
-    def get_token_usage(response_body: Dict, provider: str = None, model: str = None) -> Dict[str, int]:
-        """Extract token usage from response based on provider."""
+    def get_token_usage(response_body: Dict, model_config: KBModelConfig) -> Dict[str, int]:
+        """Extract token usage from response based on the model's provider."""
         usage = {"input_tokens": 1, "output_tokens": 1, "total_tokens": 2}  # Minimum values
 
         if not response_body:
             return usage
 
         try:
-            # Convert provider string to ModelProvider enum if possible
-            provider_enum = ModelProvider.UNKNOWN
-            if provider:
-                try:
-                    provider_enum = ModelProvider(provider.lower())
-                except ValueError:
-                    pass
-
-            # Print debug info about the response structure
-            print(f"DEBUG - Response structure keys: {list(response_body.keys() if isinstance(response_body, dict) else [])}")
+            # Log debug info about the response structure
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response structure keys: %s", list(response_body) if isinstance(response_body, dict) else [])
             
-            # Handle Bedrock's retrieve_and_generate API response
-            if provider_enum == ModelProvider.AMAZON or (isinstance(provider, str) and "amazon" in provider.lower()):
-                # The Bedrock retrieve_and_generate API might have a different structure
-                
-                # Check for metrics in retrieveAndGenerateResponse (for newer API versions)
-                if "retrieveAndGenerateResponse" in response_body and isinstance(response_body["retrieveAndGenerateResponse"], dict):
-                    metrics = response_body["retrieveAndGenerateResponse"].get("metrics", {})
-                    
-                    if isinstance(metrics, dict):
-                        if "promptTokenCount" in metrics and "completionTokenCount" in metrics:
-                            usage["input_tokens"] = max(1, metrics.get("promptTokenCount", 1))
-                            usage["output_tokens"] = max(1, metrics.get("completionTokenCount", 1))
-                            print(f"DEBUG - Found token usage in retrieveAndGenerateResponse.metrics: {usage}")
-                            return usage
-                
-                # Check for usage directly in the response
-                if "usage" in response_body and isinstance(response_body["usage"], dict):
-                    if "inputTokens" in response_body["usage"] and "outputTokens" in response_body["usage"]:
-                        usage["input_tokens"] = max(1, response_body["usage"].get("inputTokens", 1))
-                        usage["output_tokens"] = max(1, response_body["usage"].get("outputTokens", 1))
-                        print(f"DEBUG - Found token usage in usage (inputTokens/outputTokens): {usage}")
-                        return usage
-                        
-                    if "prompt_tokens" in response_body["usage"] and "completion_tokens" in response_body["usage"]:
-                        usage["input_tokens"] = max(1, response_body["usage"].get("prompt_tokens", 1))
-                        usage["output_tokens"] = max(1, response_body["usage"].get("completion_tokens", 1))
-                        print(f"DEBUG - Found token usage in usage (prompt_tokens/completion_tokens): {usage}")
-                        return usage
-                
-                # Check for responseMetadata
-                if "responseMetadata" in response_body and isinstance(response_body["responseMetadata"], dict):
-                    if "tokenUsage" in response_body["responseMetadata"]:
-                        token_usage = response_body["responseMetadata"]["tokenUsage"]
-                        if isinstance(token_usage, dict):
-                            if "promptTokens" in token_usage and "completionTokens" in token_usage:
-                                usage["input_tokens"] = max(1, token_usage.get("promptTokens", 1))
-                                usage["output_tokens"] = max(1, token_usage.get("completionTokens", 1))
-                                print(f"DEBUG - Found token usage in responseMetadata.tokenUsage: {usage}")
-                                return usage
-                
-                # For Bedrock, if we still can't find token usage, estimate based on text length
-                if "output" in response_body and "text" in response_body["output"]:
-                    output_text = response_body["output"]["text"]
-                    output_tokens = KBCostMetrics.estimate_tokens(output_text)
-                    # Estimate input tokens as roughly proportional to output tokens
-                    input_tokens = max(1, int(output_tokens * 0.5))  # Assume input is about half the size of output
-                    
-                    usage["output_tokens"] = max(1, output_tokens)
-                    usage["input_tokens"] = max(1, input_tokens)
-                    usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
-                    
-                    print(f"DEBUG - Estimated token usage from text length: {usage}")
-                    return usage
+            # Streamed invocations report token counts in the final chunk's invocation metrics
+            invocation_metrics = response_body.get("amazon-bedrock-invocationMetrics")
+            if isinstance(invocation_metrics, dict):
+                usage["input_tokens"] = max(1, invocation_metrics.get("inputTokenCount", 1))
+                usage["output_tokens"] = max(1, invocation_metrics.get("outputTokenCount", 1))
+                usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+                return usage
             
-            # Original provider-specific handling
-            if provider_enum == ModelProvider.ANTHROPIC:
-                usage["input_tokens"] = max(1, response_body.get("usage", {}).get("input_tokens", 1))
-                usage["output_tokens"] = max(1, response_body.get("usage", {}).get("output_tokens", 1))
-            elif provider_enum == ModelProvider.AMAZON and model and "nova" in model.lower():
-                usage["input_tokens"] = max(1, response_body.get("usage", {}).get("inputTokens", 1))
-                usage["output_tokens"] = max(1, response_body.get("usage", {}).get("outputTokens", 1))
-            elif provider_enum == ModelProvider.COHERE:
-                usage["total_tokens"] = max(2, response_body.get("meta", {}).get("billed_tokens", 2))
-                if "tokens" in response_body.get("meta", {}):
-                    usage["input_tokens"] = max(1, response_body["meta"]["tokens"].get("prompt_tokens", 1))
-                    usage["output_tokens"] = max(1, response_body["meta"]["tokens"].get("completion_tokens", 1))
-                else:
-                    # Fall back to approximate split if detailed token info not available
-                    usage["input_tokens"] = max(1, int(usage["total_tokens"] * 0.3))
-                    usage["output_tokens"] = max(1, usage["total_tokens"] - usage["input_tokens"])
-            elif provider_enum == ModelProvider.MISTRAL:
-                usage["input_tokens"] = max(1, response_body.get("usage", {}).get("prompt_tokens", 1))
-                usage["output_tokens"] = max(1, response_body.get("usage", {}).get("completion_tokens", 1))
-            else:
-                # For unknown providers, estimate from text content if available
-                if isinstance(response_body, dict) and "text" in response_body:
-                    total_tokens = KBCostMetrics.estimate_tokens(response_body["text"])
-                    usage["input_tokens"] = max(1, int(total_tokens * 0.3))
-                    usage["output_tokens"] = max(1, total_tokens - usage["input_tokens"])
+            # Bedrock's retrieve_and_generate API may report usage in several places
+            token_counts = None
+            if model_config.provider == ModelProvider.AMAZON:
+                token_counts = _amazon_usage(response_body)
+
+            if token_counts is None:
+                extract = _USAGE_EXTRACTORS.get(model_config.provider, _text_usage)
+                token_counts = extract(response_body, model_config)
+
+            if token_counts is not None:
+                usage["input_tokens"] = max(1, token_counts[0])
+                usage["output_tokens"] = max(1, token_counts[1])
 
             # Calculate total tokens if not already set
             usage["total_tokens"] = max(2, usage["input_tokens"] + usage["output_tokens"])
@@ -238,7 +246,7 @@ class KBCostMetrics:
                         usage["output_tokens"] = max(1, int(input_tokens * 1.5))  # Assume output is larger than input
                     
                     usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
-                    print(f"DEBUG - Estimated token usage from input/output text: {usage}")
+                    logger.debug("Estimated token usage from input/output text: %s", usage)
             
             return usage
 
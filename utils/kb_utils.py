@@ -1,128 +1,320 @@
-import json
-from typing import Dict, Any
-from decimal import Decimal, ROUND_HALF_UP
-from api.models.kb_model_config import KBModelConfigs, ModelProvider
+import hashlib
+import orjson
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional, Dict, Any, List, Callable, Tuple, Union
+from api.models.kb_model_config import KBModelConfigs, ModelProvider, KBModelConfig, AmazonFamily
 from api.models.models import GenerationSettings
-from typing import Optional, Dict, Any, AsyncGenerator, List
-from api.models.kb_model_config import KBModelConfigs, ModelProvider, ModelFamilyMapper, KBModelConfig
-from fastapi import HTTPException
-from config.logging_config import logger
+from config.aws_config import RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIZE
+
+# Completed responses keyed by a digest of the request, least recently used first
+_response_cache: "OrderedDict[bytes, Tuple[Any, float]]" = OrderedDict()
+
+def _with_system_prompt(prompt: str, system_prompt: Optional[str], context: Optional[str] = None) -> str:
+    """Prepend the system prompt and context for models without separate fields for them"""
+    return "\n\n".join(part for part in (system_prompt, context, prompt) if part)
+
+def _use_prompt_cache(model_config: KBModelConfig) -> bool:
+    # The system prompt and context repeat across requests, so they are marked as
+    # prompt cache checkpoints where the model supports it
+    return KBModelConfigs.PROMPT_CACHING and model_config.supports_prompt_caching
+
+# Request body templates per provider, copied and filled in for each request so the
+# key layout and constant fields are built once
+_ANTHROPIC_TEMPLATE = {
+    "anthropic_version": "bedrock-2023-05-31",
+    "messages": None,
+    "temperature": None,
+    "top_p": None,
+    "top_k": None,
+    "max_tokens": None,
+    "stop_sequences": None
+}
+_META_TEMPLATE = {
+    "prompt": None,
+    "temperature": None,
+    "top_p": None,
+    "max_tokens": None,
+    "stop_sequences": None
+}
+_COHERE_TEMPLATE = {
+    "message": None,
+    "temperature": None,
+    "p": None,
+    "k": None,
+    "max_tokens": None,
+    "stop_sequences": None
+}
+_NOVA_TEMPLATE = {
+    "messages": None,
+    "temperature": None,
+    "top_p": None,
+    "max_tokens": None,
+    "stop": None
+}
+_DEFAULT_TEMPLATE = {
+    "prompt": None,
+    "temperature": None,
+    "top_p": None,
+    "top_k": None,
+    "max_tokens": None,
+    "stop_sequences": None
+}
+
+# Message payload factories shared by the chat-style builders
+_USER_ROLE = "user"
+
+def _anthropic_messages(prompt: str, context: Optional[str] = None, cache: bool = False) -> List[Dict]:
+    if not context:
+        return [{"role": _USER_ROLE, "content": prompt}]
+    context_block = {"type": "text", "text": context}
+    if cache:
+        context_block["cache_control"] = {"type": "ephemeral"}
+    return [{"role": _USER_ROLE, "content": [context_block, {"type": "text", "text": prompt}]}]
+
+def _nova_messages(prompt: str, context: Optional[str] = None, cache: bool = False) -> List[Dict]:
+    if not context:
+        return [{"role": _USER_ROLE, "content": [{"text": prompt}]}]
+    content = [{"text": context}]
+    if cache:
+        content.append({"cachePoint": {"type": "default"}})
+    content.append({"text": prompt})
+    return [{"role": _USER_ROLE, "content": content}]
+
+# Request body builders, one per provider
+
+def _build_anthropic(prompt: str, model_config: KBModelConfig, system_prompt: Optional[str], context: Optional[str]) -> Dict:
+    body = _ANTHROPIC_TEMPLATE.copy()
+    body["messages"] = _anthropic_messages(prompt, context, _use_prompt_cache(model_config))
+    body["temperature"] = model_config.temperature
+    body["top_p"] = model_config.top_p
+    body["top_k"] = model_config.top_k
+    body["max_tokens"] = model_config.max_tokens
+    body["stop_sequences"] = model_config.stop_sequences
+    if system_prompt:
+        system_block = {"type": "text", "text": system_prompt}
+        if _use_prompt_cache(model_config):
+            system_block["cache_control"] = {"type": "ephemeral"}
+        body["system"] = [system_block]
+    return body
+
+def _build_meta(prompt: str, model_config: KBModelConfig, system_prompt: Optional[str], context: Optional[str]) -> Dict:
+    body = _META_TEMPLATE.copy()
+    body["prompt"] = _with_system_prompt(prompt, system_prompt, context)
+    body["temperature"] = model_config.temperature
+    body["top_p"] = model_config.top_p
+    body["max_tokens"] = model_config.max_tokens
+    body["stop_sequences"] = model_config.stop_sequences
+    return body
+
+def _build_cohere(prompt: str, model_config: KBModelConfig, system_prompt: Optional[str], context: Optional[str]) -> Dict:
+    body = _COHERE_TEMPLATE.copy()
+    body["message"] = _with_system_prompt(prompt, None, context)
+    body["temperature"] = model_config.temperature
+    body["p"] = model_config.top_p
+    body["k"] = model_config.top_k
+    body["max_tokens"] = model_config.max_tokens
+    body["stop_sequences"] = model_config.stop_sequences
+    if system_prompt:
+        body["preamble"] = system_prompt
+    return body
+
+def _build_mistral(prompt: str, model_config: KBModelConfig, system_prompt: Optional[str], context: Optional[str]) -> Dict:
+    return {
+        "inputs": _with_system_prompt(prompt, system_prompt, context),
+        "parameters": {
+            "temperature": model_config.temperature,
+            "top_p": model_config.top_p,
+            "max_tokens": model_config.max_tokens,
+            "stop": model_config.stop_sequences
+        }
+    }
+
+def _build_nova(prompt: str, model_config: KBModelConfig, system_prompt: Optional[str], context: Optional[str]) -> Dict:
+    body = _NOVA_TEMPLATE.copy()
+    body["messages"] = _nova_messages(prompt, context, _use_prompt_cache(model_config))
+    body["temperature"] = model_config.temperature
+    body["top_p"] = model_config.top_p
+    body["max_tokens"] = model_config.max_tokens
+    body["stop"] = model_config.stop_sequences
+    if system_prompt:
+        body["system"] = [{"text": system_prompt}]
+        if _use_prompt_cache(model_config):
+            body["system"].append({"cachePoint": {"type": "default"}})
+    return body
+
+def _build_titan(prompt: str, model_config: KBModelConfig, system_prompt: Optional[str], context: Optional[str]) -> Dict:
+    return {
+        "inputText": _with_system_prompt(prompt, system_prompt, context),
+        "textGenerationConfig": {
+            "maxTokenCount": model_config.max_tokens,
+            "temperature": model_config.temperature,
+            "topP": model_config.top_p,
+            "topK": model_config.top_k,
+            "stopSequences": model_config.stop_sequences
+        }
+    }
+
+def _build_amazon(prompt: str, model_config: KBModelConfig, system_prompt: Optional[str], context: Optional[str]) -> Dict:
+    # Handle different Amazon models (Nova vs Titan)
+    if model_config.amazon_family is AmazonFamily.NOVA:
+        return _build_nova(prompt, model_config, system_prompt, context)
+    return _build_titan(prompt, model_config, system_prompt, context)
+
+def _build_default(prompt: str, model_config: KBModelConfig, system_prompt: Optional[str], context: Optional[str]) -> Dict:
+    # Default format for unknown providers
+    body = _DEFAULT_TEMPLATE.copy()
+    body["prompt"] = _with_system_prompt(prompt, system_prompt, context)
+    body["temperature"] = model_config.temperature
+    body["top_p"] = model_config.top_p
+    body["top_k"] = model_config.top_k
+    body["max_tokens"] = model_config.max_tokens
+    body["stop_sequences"] = model_config.stop_sequences
+    return body
+
+_REQUEST_BUILDERS: Dict[ModelProvider, Callable[[str, KBModelConfig, Optional[str], Optional[str]], Dict]] = {
+    ModelProvider.ANTHROPIC: _build_anthropic,
+    ModelProvider.META: _build_meta,
+    ModelProvider.COHERE: _build_cohere,
+    ModelProvider.MISTRAL: _build_mistral,
+    ModelProvider.AMAZON: _build_amazon,
+}
+
+# Generated text extractors for complete responses, one per provider
+
+# Responses normally carry the text, so it is indexed directly and a missing part
+# yields empty text instead of building default containers on every call
+
+def _extract_anthropic_text(response_body: Dict, model_config: KBModelConfig) -> str:
+    try:
+        return response_body["content"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+def _extract_amazon_text(response_body: Dict, model_config: KBModelConfig) -> str:
+    try:
+        if model_config.amazon_family is AmazonFamily.NOVA:
+            return response_body["output"]["message"]["content"][0]["text"]
+        # Titan
+        return response_body["results"][0]["outputText"]
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+def _extract_mistral_text(response_body: Dict, model_config: KBModelConfig) -> str:
+    try:
+        return response_body["outputs"][0]["text"].strip()
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+def _extract_default_text(response_body: Dict, model_config: KBModelConfig) -> str:
+    return response_body.get("completion", "")
+
+_TEXT_EXTRACTORS: Dict[ModelProvider, Callable[[Dict, KBModelConfig], str]] = {
+    ModelProvider.ANTHROPIC: _extract_anthropic_text,
+    ModelProvider.META: lambda response_body, model_config: response_body.get("generation", ""),
+    ModelProvider.COHERE: lambda response_body, model_config: response_body.get("text", ""),
+    ModelProvider.AMAZON: _extract_amazon_text,
+    ModelProvider.MISTRAL: _extract_mistral_text,
+}
+
+# Text delta extractors for streamed chunks, one per provider
+
+def _extract_anthropic_delta(chunk_body: Dict, model_config: KBModelConfig) -> str:
+    if chunk_body.get("type") == "content_block_delta":
+        return chunk_body["delta"].get("text", "")
+    return ""
+
+def _extract_amazon_delta(chunk_body: Dict, model_config: KBModelConfig) -> str:
+    if model_config.amazon_family is AmazonFamily.NOVA:
+        # Only content block deltas carry text; start, stop and metadata events don't
+        block_delta = chunk_body.get("contentBlockDelta")
+        return block_delta["delta"].get("text", "") if block_delta else ""
+    # Titan
+    return chunk_body.get("outputText", "")
+
+def _extract_mistral_delta(chunk_body: Dict, model_config: KBModelConfig) -> str:
+    outputs = chunk_body.get("outputs")
+    return outputs[0].get("text", "") if outputs else ""
+
+def _extract_default_delta(chunk_body: Dict, model_config: KBModelConfig) -> str:
+    return chunk_body.get("completion", "")
+
+_STREAM_TEXT_EXTRACTORS: Dict[ModelProvider, Callable[[Dict, KBModelConfig], str]] = {
+    ModelProvider.ANTHROPIC: _extract_anthropic_delta,
+    ModelProvider.META: lambda chunk_body, model_config: chunk_body.get("generation", ""),
+    ModelProvider.COHERE: lambda chunk_body, model_config: chunk_body.get("text", ""),
+    ModelProvider.AMAZON: _extract_amazon_delta,
+    ModelProvider.MISTRAL: _extract_mistral_delta,
+}
+
+# Hot-path request/response helpers; KBUtils keeps its static method names for them
+
+def prepare_request_body(
+    prompt: str,
+    settings: GenerationSettings,
+    model_arn: str,
+    system_prompt: Optional[str] = None,
+    as_bytes: bool = False,
+    context: Optional[str] = None
+) -> Union[Dict, bytes]:
+    """Prepare request body based on model provider, serialized to JSON bytes if as_bytes is set
+
+    A context (e.g. reference documents reused across questions) is sent ahead of the
+    prompt as a prompt cache checkpoint where the model supports it.
+    """
+    # Get model configuration
+    model_config = KBModelConfigs.get_config(model_arn)
+
+    # Update config with request settings if provided
+    if settings:
+        model_config = model_config.update_from_settings(settings)
+
+    # Format request based on provider
+    build = _REQUEST_BUILDERS.get(model_config.provider, _build_default)
+    body = build(prompt, model_config, system_prompt, context)
+    return orjson.dumps(body) if as_bytes else body
+
+def extract_generated_text(response_body: Dict, model_config: KBModelConfig) -> str:
+    """Extract generated text from response based on model provider"""
+    extract = _TEXT_EXTRACTORS.get(model_config.provider, _extract_default_text)
+    return extract(response_body, model_config)
+
+def extract_stream_text(chunk_body: Dict, model_config: KBModelConfig) -> str:
+    """Extract the text delta from a streamed response chunk based on model provider"""
+    extract = _STREAM_TEXT_EXTRACTORS.get(model_config.provider, _extract_default_delta)
+    return extract(chunk_body, model_config)
+
+# Completed response cache, shared by all queries in the process
+
+def response_cache_key(*parts: Optional[str]) -> bytes:
+    """Digest the parts that determine a response into a response cache key"""
+    return hashlib.blake2b(orjson.dumps(parts), digest_size=16).digest()
+
+def get_cached_response(key: bytes) -> Optional[Any]:
+    """Return a cached response if it has not expired"""
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    if entry[1] <= monotonic():
+        del _response_cache[key]
+        return None
+    _response_cache.move_to_end(key)
+    return entry[0]
+
+def cache_response(key: bytes, response: Any) -> None:
+    """Store a response, evicting the least recently used ones beyond the cache size"""
+    if RESPONSE_CACHE_TTL <= 0 or RESPONSE_CACHE_SIZE <= 0:
+        return
+    _response_cache[key] = (response, monotonic() + RESPONSE_CACHE_TTL)
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > RESPONSE_CACHE_SIZE:
+        _response_cache.popitem(last=False)
+
+def clear_response_cache() -> None:
+    """Drop all cached responses, e.g. after the knowledge base content changes"""
+    _response_cache.clear()
 
 class KBUtils:
-    @staticmethod
-    def _prepare_request_body(prompt: str, settings: GenerationSettings, model_arn: str) -> Dict:
-        """Prepare request body based on model provider"""
-        try:
-            # Get model configuration
-            model_config = KBModelConfigs.get_config(model_arn)
-            
-            # Update config with request settings if provided
-            if settings:
-                model_config.update_from_settings(settings)
-            
-            # Format request based on provider
-            if model_config.provider == ModelProvider.ANTHROPIC:
-                return {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": model_config.temperature,
-                    "top_p": model_config.top_p,
-                    "top_k": model_config.top_k,
-                    "max_tokens": model_config.max_tokens,
-                    "stop_sequences": model_config.stop_sequences
-                }
-            elif model_config.provider == ModelProvider.META:
-                return {
-                    "prompt": prompt,
-                    "temperature": model_config.temperature,
-                    "top_p": model_config.top_p,
-                    "max_tokens": model_config.max_tokens,
-                    "stop_sequences": model_config.stop_sequences
-                }
-            elif model_config.provider == ModelProvider.COHERE:
-                return {
-                    "message": prompt,
-                    "temperature": model_config.temperature,
-                    "p": model_config.top_p,
-                    "k": model_config.top_k,
-                    "max_tokens": model_config.max_tokens,
-                    "stop_sequences": model_config.stop_sequences
-                }
-            elif model_config.provider == ModelProvider.MISTRAL:
-                return {
-                    "inputs": prompt,
-                    "parameters": {
-                        "temperature": model_config.temperature,
-                        "top_p": model_config.top_p,
-                        "max_tokens": model_config.max_tokens,
-                        "stop": model_config.stop_sequences
-                    }
-                }
-            elif model_config.provider == ModelProvider.AMAZON:
-                # Handle different Amazon models (Nova vs Titan)
-                model_family = ModelFamilyMapper.get_family(model_config.model_id)
-                
-                if "nova" in model_family:
-                    return {
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": [{"text": prompt}]
-                            }
-                        ],
-                        "temperature": model_config.temperature,
-                        "top_p": model_config.top_p,
-                        "max_tokens": model_config.max_tokens,
-                        "stop": model_config.stop_sequences
-                    }
-                else:  # Titan models
-                    return {
-                        "inputText": prompt,
-                        "textGenerationConfig": {
-                            "maxTokenCount": model_config.max_tokens,
-                            "temperature": model_config.temperature,
-                            "topP": model_config.top_p,
-                            "topK": model_config.top_k,
-                            "stopSequences": model_config.stop_sequences
-                        }
-                    }
-            else:
-                # Default format for unknown providers
-                return {
-                    "prompt": prompt,
-                    "temperature": model_config.temperature,
-                    "top_p": model_config.top_p,
-                    "top_k": model_config.top_k,
-                    "max_tokens": model_config.max_tokens,
-                    "stop_sequences": model_config.stop_sequences
-                }
-                
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error preparing request: {str(e)}")
-
-    @staticmethod
-    def _extract_generated_text(response_body: Dict, model_config: KBModelConfig) -> str:
-        """Extract generated text from response based on model provider"""
-        try:
-            if model_config.provider == ModelProvider.ANTHROPIC:
-                return response_body["content"][0]["text"]
-            elif model_config.provider == ModelProvider.META:
-                return response_body.get("generation", "")
-            elif model_config.provider == ModelProvider.COHERE:
-                return response_body.get("text", "")
-            elif model_config.provider == ModelProvider.AMAZON:
-                model_family = ModelFamilyMapper.get_family(model_config.model_id)
-                if "nova" in model_family:
-                    message = response_body["output"].get("message", {})
-                    content = message.get("content", [])
-                    return content[0]["text"] if content else ""
-                else:  # Titan
-                    return response_body.get("results", [{}])[0].get("outputText", "")
-            elif model_config.provider == ModelProvider.MISTRAL:
-                if "outputs" in response_body and response_body["outputs"]:
-                    return response_body["outputs"][0].get("text", "").strip()
-                return ""
-            else:
-                return response_body.get("completion", "")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error extracting response: {str(e)}")
\ No newline at end of file
+    _prepare_request_body = staticmethod(prepare_request_body)
+    _extract_generated_text = staticmethod(extract_generated_text)
+    _extract_stream_text = staticmethod(extract_stream_text)